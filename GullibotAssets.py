@@ -0,0 +1,109 @@
+"""
+Script asset catalog for Gullibot.
+
+ScriptCatalog lists the script directory once, reads each text file once and
+compiles it into LCD pages (lists of 4 x 20 strings) ready for
+writeToCharDisplay. The result is saved as a marshal bundle next to the
+directory; on the next start, files whose mtime and size are unchanged are
+taken from the bundle without being opened.
+"""
+
+import os
+import marshal
+
+BUNDLE_VERSION = 2
+
+class ScriptCatalog(object):
+    def __init__(self, scriptPath, compileText, lineLength=20, numLines=4,
+                 bundlePath=None, verbose=True):
+        # compileText: callable taking raw text, returning a list of pages.
+        self.scriptPath = scriptPath
+        self.compileText = compileText
+        (self.lineLength, self.numLines) = (lineLength, numLines)
+        if (bundlePath == None):
+            bundlePath = scriptPath.rstrip("/") + ".bundle" # Not in scriptPath.
+        self.bundlePath = bundlePath
+        self.verbose = verbose
+        self.entries = {} # fileName -> entry dict
+        self.fileNames = []
+        self.filesRead = 0
+
+    def bundleKey(self):
+        return (BUNDLE_VERSION, self.lineLength, self.numLines)
+
+    def loadBundle(self):
+        try:
+            with open(self.bundlePath, "rb") as data:
+                (key, entries) = marshal.load(data)
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}
+        if (key != self.bundleKey()): return {}
+        return entries
+
+    def saveBundle(self):
+        tempPath = self.bundlePath + ".tmp"
+        try:
+            with open(tempPath, "wb") as data:
+                marshal.dump((self.bundleKey(), self.entries), data)
+            os.rename(tempPath, self.bundlePath)
+        except (IOError, OSError):
+            pass # A read-only checkout just means no bundle next time.
+
+    def load(self):
+        # One directory listing; each file is read only if the bundle is stale.
+        cached = self.loadBundle()
+        self.fileNames = sorted(os.listdir(self.scriptPath))
+        self.entries = {}
+        self.filesRead = 0
+        for index in xrange(len(self.fileNames)):
+            fileName = self.fileNames[index]
+            if not fileName.endswith(".txt"): continue
+            fullPath = os.path.join(self.scriptPath, fileName)
+            info = os.stat(fullPath)
+            entry = cached.get(fileName, None)
+            if ((entry == None) or (entry["mtime"] != info.st_mtime) or
+                (entry["size"] != info.st_size)):
+                with open(fullPath, 'r') as data:
+                    text = data.read()
+                self.filesRead += 1
+                entry = { "mtime":info.st_mtime, "size":info.st_size,
+                          "text":text, "pages":self.compileText(text) }
+            entry["index"] = index # Position in the sorted listing.
+            entry["path"] = fullPath
+            self.entries[fileName] = entry
+        if (self.filesRead > 0) or (len(cached) != len(self.entries)):
+            self.saveBundle()
+        return self
+
+    def fits(self, entry):
+        # Longer texts are paginated, so anything with a page is usable.
+        return (len(entry["pages"]) > 0)
+
+    def report(self, entry):
+        if not self.verbose: return
+        numPages = len(entry["pages"])
+        if (numPages > 1):
+            print entry["path"], "OK! (%d pages)" % numPages
+        elif self.fits(entry):
+            print entry["path"], "OK!"
+        else:
+            print entry["path"], "No text."
+
+    def find(self, prefix):
+        # 1st usable file (sorted) whose name starts with prefix, or None.
+        for fileName in self.fileNames:
+            entry = self.entries.get(fileName, None)
+            if (entry != None) and fileName.startswith(prefix):
+                self.report(entry)
+                if self.fits(entry): return entry
+        return None
+
+    def findAll(self, prefix):
+        # Every usable file starting with prefix, keyed by listing index.
+        found = {}
+        for fileName in self.fileNames:
+            entry = self.entries.get(fileName, None)
+            if (entry != None) and fileName.startswith(prefix):
+                self.report(entry)
+                if self.fits(entry): found[entry["index"]] = entry
+        return found
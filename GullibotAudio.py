@@ -0,0 +1,251 @@
+"""
+Audio for Gullibot.
+
+Clips are decoded once with the wave module and kept as raw PCM in the
+memory of a separate worker process, which plays them while the session
+keeps moving. The session talks to the worker over a small command queue
+("play", "stop", "quit"); play() returns as soon as the command is queued,
+so a spoken line never holds up the motion loop or the console. Clips play
+in the order queued; "stop" cuts off the current one and drops the clips
+queued before it (ones queued after it still play). A clip the sink cannot
+play (e.g. aplay is not installed) is reported and skipped.
+
+Sinks (where the worker sends PCM):
+    "aplay"   pipes to ALSA's aplay (on the Pi)
+    "null"    discards samples, paced in real time like a sound card
+    "file"    writes each clip played to a .wav file in sinkDirectory
+
+Note: on the Pi, servoblaster's default PWM timing shares hardware with
+the analog audio output; run servod with --pcm when audio is enabled.
+"""
+
+import os
+import time
+import wave
+import subprocess
+import collections
+import multiprocessing
+import Queue
+
+CHUNK_SECONDS = 0.05 # Granularity of playback, so "stop" acts quickly.
+
+def loadClip(path):
+    # Decodes a .wav file to { "channels", "width", "rate", "frames" }.
+    clip = wave.open(path, "rb")
+    try:
+        return { "channels": clip.getnchannels(), "width": clip.getsampwidth(),
+                 "rate": clip.getframerate(),
+                 "frames": clip.readframes(clip.getnframes()) }
+    finally:
+        clip.close()
+
+def clipSeconds(clip):
+    bytesPerSecond = clip["channels"] * clip["width"] * clip["rate"]
+    return len(clip["frames"]) / float(bytesPerSecond)
+
+class NullSink(object):
+    # Discards PCM, but takes as long as a sound card would.
+    def __init__(self):
+        self.deadline = None
+
+    def open(self, clip):
+        self.deadline = time.time()
+
+    def write(self, clip, frames):
+        bytesPerSecond = clip["channels"] * clip["width"] * clip["rate"]
+        self.deadline += len(frames) / float(bytesPerSecond)
+        remaining = self.deadline - time.time()
+        if (remaining > 0): time.sleep(remaining)
+
+    def finish(self):
+        pass
+
+    def close(self):
+        pass
+
+class FileSink(NullSink):
+    # Writes each clip played to sinkDirectory/playNNN.wav (real-time paced).
+    def __init__(self, sinkDirectory):
+        NullSink.__init__(self)
+        self.sinkDirectory = sinkDirectory
+        self.count = 0
+        self.output = None
+
+    def open(self, clip):
+        NullSink.open(self, clip)
+        path = os.path.join(self.sinkDirectory, "play%03d.wav" % self.count)
+        self.count += 1
+        self.output = wave.open(path, "wb")
+        self.output.setnchannels(clip["channels"])
+        self.output.setsampwidth(clip["width"])
+        self.output.setframerate(clip["rate"])
+
+    def write(self, clip, frames):
+        self.output.writeframes(frames)
+        NullSink.write(self, clip, frames)
+
+    def finish(self):
+        if (self.output != None): self.output.close()
+        self.output = None
+
+class AplaySink(object):
+    # Streams raw PCM to aplay, which blocks like the sound card does.
+    formats = { 1: "U8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE" }
+
+    def __init__(self):
+        self.process = None
+
+    def open(self, clip):
+        try:
+            self.process = subprocess.Popen(
+                [ "aplay", "-q", "-t", "raw", "-f", AplaySink.formats[clip["width"]],
+                  "-c", str(clip["channels"]), "-r", str(clip["rate"]) ],
+                stdin=subprocess.PIPE)
+        except OSError as error:
+            self.process = None
+            raise IOError("Cannot run aplay: %s" % error)
+
+    def write(self, clip, frames):
+        self.process.stdin.write(frames) # IOError if aplay has exited.
+
+    def finish(self):
+        if (self.process != None):
+            try:
+                self.process.stdin.close()
+            except IOError: # aplay exited early; its pipe is broken.
+                pass
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        self.finish()
+
+def makeSink(sink, sinkDirectory=None):
+    if (sink == "aplay"): return AplaySink()
+    elif (sink == "null"): return NullSink()
+    elif (sink == "file"): return FileSink(sinkDirectory or ".")
+    raise ValueError("Unknown audio sink: %r" % sink)
+
+def lastStop(backlog):
+    # Index of the last "stop" or "quit" in backlog, or None.
+    for index in xrange(len(backlog) - 1, -1, -1):
+        if (backlog[index][0] in ["stop", "quit"]): return index
+    return None
+
+def audioWorker(paths, commands, events, sink, sinkDirectory):
+    # Runs in the worker process: decode everything, then serve commands.
+    clips = {}
+    for path in paths:
+        try:
+            clips[path] = loadClip(path)
+        except (IOError, EOFError, wave.Error) as error:
+            events.put(("error", path, str(error)))
+    output = makeSink(sink, sinkDirectory)
+    events.put(("ready", sorted(clips), None))
+    backlog = collections.deque() # Commands that arrived during a clip.
+    while True:
+        command = backlog.popleft() if backlog else commands.get()
+        if (command[0] == "quit"): break
+        elif (command[0] != "play"): continue # "stop" with nothing playing.
+        clip = clips.get(command[1], None)
+        if (clip == None):
+            events.put(("skipped", command[1], "Clip not loaded."))
+            continue
+        try:
+            output.open(clip)
+        except (IOError, OSError) as error:
+            events.put(("skipped", command[1], str(error)))
+            continue
+        events.put(("started", command[1], time.time()))
+        frameBytes = clip["channels"] * clip["width"]
+        chunk = max(1, int(clip["rate"] * CHUNK_SECONDS)) * frameBytes
+        frames = clip["frames"]
+        for offset in xrange(0, len(frames), chunk):
+            while True: # Everything that arrived since the last chunk.
+                try:
+                    backlog.append(commands.get_nowait())
+                except Queue.Empty:
+                    break
+            if (lastStop(backlog) != None): break
+            try:
+                output.write(clip, frames[offset:offset + chunk])
+            except (IOError, OSError) as error:
+                events.put(("error", command[1], str(error)))
+                break
+        output.finish()
+        events.put(("finished", command[1], time.time()))
+        stop = lastStop(backlog)
+        if (stop != None): # Drop what was queued before it; keep the rest.
+            queued = list(backlog)
+            backlog.clear()
+            for dropped in queued[:stop]:
+                if (dropped[0] == "play"): events.put(("dropped", dropped[1], None))
+                elif (dropped[0] == "quit"): backlog.append(dropped)
+            backlog.extend(queued[stop:])
+    output.close()
+
+class AudioPlayer(object):
+    # Session audio backend: play() queues a clip and returns at once.
+    def __init__(self, paths, sink="aplay", sinkDirectory=None):
+        self.commands = multiprocessing.Queue()
+        self.events = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=audioWorker, name="audio",
+            args=(list(paths), self.commands, self.events, sink, sinkDirectory))
+        self.process.daemon = True
+        self.process.start()
+        self.loaded = None   # Paths the worker decoded, once it is ready.
+        self.errors = []
+        self.playing = 0     # Clips queued or playing.
+        self.played = 0
+
+    def poll(self, timeout=0.0):
+        # Reads worker events; waits up to timeout for the first one.
+        while True:
+            try:
+                (kind, name, value) = self.events.get(timeout > 0, timeout or None)
+            except Queue.Empty:
+                return
+            timeout = 0.0
+            if (kind == "ready"): self.loaded = name
+            elif (kind == "error"): self.errors.append((name, value))
+            elif (kind == "dropped"):
+                self.playing -= 1
+            elif (kind == "skipped"):
+                self.errors.append((name, value))
+                self.playing -= 1
+            elif (kind == "finished"):
+                self.playing -= 1
+                self.played += 1
+
+    def waitReady(self, timeout=10.0):
+        deadline = time.time() + timeout
+        while (self.loaded == None) and (time.time() < deadline):
+            self.poll(deadline - time.time())
+        return self.loaded != None
+
+    def play(self, soundFile):
+        self.poll()
+        self.playing += 1
+        self.commands.put(("play", soundFile))
+
+    def stop(self):
+        self.commands.put(("stop",))
+
+    def wait(self, timeout=None):
+        # Blocks until everything queued has finished (or timeout).
+        deadline = None if (timeout == None) else time.time() + timeout
+        while (self.playing > 0):
+            if not self.process.is_alive():
+                self.poll() # Whatever it said before it went.
+                if (self.playing > 0): raise IOError("Audio process died.")
+                break
+            if (deadline != None) and (time.time() >= deadline): return False
+            self.poll(0.05)
+        return True
+
+    def close(self):
+        if self.process.is_alive():
+            self.commands.put(("quit",))
+            self.process.join(2.0)
+        if self.process.is_alive(): self.process.terminate()
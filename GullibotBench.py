@@ -0,0 +1,941 @@
+"""
+Benchmarks for Gullibot.
+
+Run from the repository directory:
+    python GullibotBench.py wrap
+    python GullibotBench.py suite [--quick] [--output results.json]
+    python GullibotBench.py trace
+    python GullibotBench.py startup
+    python GullibotBench.py audio
+    python GullibotBench.py profile
+    python GullibotBench.py motion
+    python GullibotBench.py cancel
+    python GullibotBench.py record
+    python GullibotBench.py replay
+    python GullibotBench.py lcd
+    python GullibotBench.py server
+    python GullibotBench.py check
+
+The suite drives GullibotSession through representative workloads on the
+recording stand-in devices and reports, per workload: wall time, motion
+tick jitter percentiles, device writes per second, time spent writing
+versus sleeping, and the process's peak RSS. Results are JSON, so runs
+from different commits can be compared.
+
+"check" runs quick pass/fail checks of behaviour the benchmarks rely on
+(rejected commands, recorder round trips, command lines) and exits nonzero
+if any fails.
+"""
+
+import os
+import sys
+import csv
+import time
+import json
+import random
+import resource
+import math
+import wave
+import shutil
+import tempfile
+import StringIO
+import argparse
+import threading
+import subprocess
+import distutils.spawn
+
+from GullibotText import wrapLines, paginate
+from GullibotCmd import GullibotSession, commandLineParser
+from GullibotDevices import (EventLog, RecordingPWM, RecordingDisplay,
+                             RecordingAudio)
+from GullibotTrace import Tracer, NullTracer
+from GullibotAudio import AudioPlayer
+import GullibotMotion
+from GullibotDevices import ServoblasterWriter
+from GullibotRealtime import MotionProcess
+from GullibotRecorder import (NullRecorder, SessionRecorder, readSession,
+                              exportCsv, COMMAND, ANSWER)
+from GullibotClock import SimulatedClock
+from GullibotDisplay import CharFramebuffer, MemoryCharDisplay, TRANSACTIONS_PER_BYTE
+from GullibotLCD import HD44780, StandInBus
+from GullibotCommands import runBatch
+from GullibotTimeline import Timeline, TimelineError
+from GullibotServer import loadTest, standInSession, UnixCommandServer, CommandClient
+
+def legacyWrap(text, lineLength=20):
+    # The original lcdParser loop (words.pop(0)), run until out of words.
+    lines = []
+    words = text.replace("\n", " ").split(" ")
+    while words:
+        thisLine = []
+        used = 0
+        while words and (used + len(words[0])) <= lineLength:
+            used += (len(words[0]) + 1)
+            thisLine.append(words.pop(0))
+        if not thisLine: break # Word longer than a line: the old code stalls.
+        lines.append(" ".join(thisLine).strip().ljust(lineLength))
+    return lines
+
+def makeText(numWords, seed=2014):
+    rand = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = []
+    for i in xrange(numWords):
+        words.append("".join(rand.choice(letters)
+                             for j in xrange(rand.randint(1, 12))))
+    return " ".join(words)
+
+def timeIt(function, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if (best == None) or (elapsed < best): best = elapsed
+    return best
+
+def benchWrap(sizes=(1000, 10000, 50000)):
+    # Streaming wrapper vs. the old pop(0) loop, on growing texts.
+    results = []
+    for numWords in sizes:
+        text = makeText(numWords)
+        assert( list(wrapLines(text)) == legacyWrap(text) )
+        legacy = timeIt(lambda: legacyWrap(text))
+        streaming = timeIt(lambda: list(wrapLines(text)))
+        results.append({ "words": numWords, "chars": len(text),
+                         "legacySeconds": legacy,
+                         "streamingSeconds": streaming,
+                         "streamingMBps": len(text) / streaming / 1e6 })
+    return results
+
+def printWrap(results):
+    print "%8s %10s %12s %12s %8s" % ("words", "chars", "legacy s",
+                                     "streaming s", "MB/s")
+    for row in results:
+        print "%8d %10d %12.4f %12.4f %8.2f" % (
+            row["words"], row["chars"], row["legacySeconds"],
+            row["streamingSeconds"], row["streamingMBps"])
+
+class TimedPWM(RecordingPWM):
+    # Recording PWM that also adds up the time spent in device writes.
+    def __init__(self, log):
+        RecordingPWM.__init__(self, log)
+        self.writeSeconds = 0.0
+
+    def flush(self):
+        start = time.time()
+        RecordingPWM.flush(self)
+        self.writeSeconds += time.time() - start
+
+class Quiet(object):
+    # Swallows the session's console output while a workload runs.
+    def __enter__(self):
+        (self.stdout, sys.stdout) = (sys.stdout, open(os.devnull, "w"))
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def makeSession(answers=()):
+    # A full session on stand-in devices; answers feed raw_input in order.
+    log = EventLog()
+    answers = list(answers)
+    def readInput(prompt=""):
+        return answers.pop(0) if answers else "n"
+    with Quiet():
+        session = GullibotSession(pwm=TimedPWM(log), display=RecordingDisplay(log),
+                                  audio=RecordingAudio(log), inputFunc=readInput)
+        session.ensureAssets() # Loaded in the background; quietly, too.
+    clock = session.motionClock
+    clock.sleepSeconds = 0.0
+    def timedSleep(seconds, realSleep=clock.sleep):
+        start = time.time()
+        realSleep(seconds)
+        clock.sleepSeconds += time.time() - start
+    clock.sleep = timedSleep
+    return session
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runWorkload(name, action, answers=()):
+    session = makeSession(answers)
+    (writer, clock) = (session.servoWriter, session.motionClock)
+    writer.resetCounters()
+    clock.resetStats()
+    session.frameBuffer.resetCounters()
+    start = time.time()
+    with Quiet():
+        action(session)
+    wall = time.time() - start
+    stats = clock.stats()
+    return { "workload": name,
+             "wallSeconds": wall,
+             "ticks": stats["ticks"],
+             "jitterP50Ms": stats["jitterP50"] * 1000,
+             "jitterP99Ms": stats["jitterP99"] * 1000,
+             "maxLatenessMs": stats["maxLateness"] * 1000,
+             "missedDeadlines": stats["missedDeadlines"],
+             "deviceWrites": writer.writesIssued,
+             "deviceWritesPerSecond": writer.writesIssued / wall if wall else 0,
+             "updatesSkipped": writer.writesSkipped,
+             "writeSeconds": writer.writeSeconds,
+             "sleepSeconds": clock.sleepSeconds,
+             "lcdBytes": session.frameBuffer.bytesSent,
+             "peakRssKb": peakRSS() }
+
+def workloads(quick=False):
+    # (name, action, scripted operator answers)
+    def move(mode, delta):
+        return lambda session: session.panOrTilt(
+            [mode, str(session.servoPositions[mode] + delta)], mode)
+    def allAdvice(session):
+        for key in sorted(session.allAdvice):
+            session.say(["say", str(key)])
+    loads = []
+    for delta in [1, 5, 15]:
+        loads.append(("pan %+d" % -delta, move("pan", -delta), ()))
+    for delta in [5, 15, 25]:
+        loads.append(("tilt %+d" % -delta, move("tilt", -delta), ()))
+    loads.append(("nod", lambda session: session.nod(blink=True), ()))
+    loads.append(("scan", lambda session: session.runScan(), ()))
+    loads.append(("advice", allAdvice, ()))
+    if not quick:
+        def testLEDs(session):
+            session.testLEDs()
+            session.leds.wait() # Patterns run in the background.
+        loads.append(("testLEDs", testLEDs, ()))
+        loads.append(("fullScript", lambda session: session.runFullScript(),
+                      ["pan 175", "next", "", "", "", "", "n"]))
+    return loads
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchSuite(quick=False):
+    results = [ runWorkload(name, action, answers)
+                for (name, action, answers) in workloads(quick) ]
+    return { "revision": gitRevision(), "time": time.time(),
+             "python": sys.version.split()[0], "workloads": results }
+
+def printSuite(report):
+    print "%-12s %8s %8s %8s %8s %9s %8s %8s" % ("workload", "wall s",
+        "p50 ms", "p99 ms", "writes", "writes/s", "write s", "sleep s")
+    for row in report["workloads"]:
+        print "%-12s %8.3f %8.3f %8.3f %8d %9.1f %8.4f %8.3f" % (
+            row["workload"], row["wallSeconds"], row["jitterP50Ms"],
+            row["jitterP99Ms"], row["deviceWrites"],
+            row["deviceWritesPerSecond"], row["writeSeconds"],
+            row["sleepSeconds"])
+
+def benchTrace(calls=200000):
+    # Cost per setServo call with tracing off (no wrapper) and on, plus the
+    # per-stage cost of the NullTracer left in runFullScript.
+    results = {}
+    for (label, tracer) in [("off", NullTracer()), ("on", Tracer())]:
+        with Quiet():
+            session = GullibotSession(lcdActive=False, tracer=tracer,
+                                      pwm=RecordingPWM(EventLog(maxEvents=16)))
+        setServo = session.setServo
+        start = time.time()
+        for i in xrange(calls):
+            setServo(0, 150 + (i & 1))
+        results[label + "MicrosPerSetServo"] = (time.time() - start) / calls * 1e6
+    null = NullTracer()
+    start = time.time()
+    for i in xrange(calls):
+        null.stage("stage")
+    results["nullStageMicros"] = (time.time() - start) / calls * 1e6
+    results["tracingOverheadMicros"] = (results["onMicrosPerSetServo"] -
+                                        results["offMicrosPerSetServo"])
+    return results
+
+STARTUP_CHILD = """
+import json, time
+start = time.time()
+from GullibotCmd import GullibotSession, commandLineParser
+from GullibotDevices import EventLog, RecordingPWM, RecordingDisplay
+session = GullibotSession(pwm=RecordingPWM(EventLog()),
+                          display=RecordingDisplay(EventLog()))
+ready = time.time() - start
+session.ensureAssets()
+phases = dict(session.startup.phases)
+session.close()
+print json.dumps({ "readySeconds": ready, "phases": phases })
+"""
+
+def benchStartup(runs=5):
+    # Launches fresh interpreters up to a ready session, with and without
+    # script.bundle; launchSeconds includes interpreter startup and exit.
+    results = []
+    for cold in [True, False]:
+        for run in xrange(runs):
+            if cold and os.path.exists("script.bundle"): os.remove("script.bundle")
+            start = time.time()
+            output = subprocess.check_output([sys.executable, "-c", STARTUP_CHILD])
+            row = json.loads(output.splitlines()[-1])
+            row.update({ "bundle": "cold" if cold else "warm",
+                         "launchSeconds": time.time() - start })
+            results.append(row)
+    return results
+
+def printStartup(results):
+    print "%6s %10s %10s %10s %10s" % ("bundle", "launch s", "ready s",
+                                       "servos s", "assets s")
+    for row in results:
+        print "%6s %10.3f %10.3f %10.3f %10.3f" % (
+            row["bundle"], row["launchSeconds"], row["readySeconds"],
+            row["phases"]["servos"], row["phases"]["assets"])
+
+def writeTone(path, seconds=2.0, rate=22050, pitch=440.0):
+    # A 16-bit mono sine clip, standing in for recorded advice.
+    clip = wave.open(path, "wb")
+    clip.setnchannels(1)
+    clip.setsampwidth(2)
+    clip.setframerate(rate)
+    samples = [ int(12000 * math.sin(2 * math.pi * pitch * n / rate))
+                for n in xrange(int(seconds * rate)) ]
+    clip.writeframes("".join(wave.struct.pack("<h", sample) for sample in samples))
+    clip.close()
+
+def benchAudio(sweeps=4):
+    # Tilt sweeps alone, then with "say" playing audio (null sink) on a
+    # second thread: tick jitter should not change, and play() should
+    # return in well under a tick.
+    directory = tempfile.mkdtemp()
+    tone = os.path.join(directory, "advice.wav")
+    writeTone(tone)
+    results = []
+    try:
+        for withAudio in [False, True]:
+            session = makeSession()
+            audio = None
+            if withAudio:
+                audio = AudioPlayer([tone], sink="null")
+                audio.waitReady()
+                (session.audio, session.audioActive) = (audio, True)
+            session.audioFiles = dict((key, tone) for key in session.allAdvice)
+            playCalls = []
+            def talk():
+                for key in sorted(session.allAdvice)[:3]:
+                    start = time.time()
+                    session.audioSay(key)
+                    playCalls.append(time.time() - start)
+                    session.showPages(session.advicePages[key], pageTime=0.5)
+            clock = session.motionClock
+            clock.resetStats()
+            start = time.time()
+            with Quiet():
+                talker = threading.Thread(target=talk)
+                talker.start()
+                for sweep in xrange(sweeps):
+                    session.panOrTilt(["tilt", "150" if (sweep % 2 == 0) else "190"],
+                                      "tilt")
+                talker.join()
+                if (audio != None): audio.wait(30.0)
+            stats = clock.stats()
+            results.append({ "audio": withAudio, "wallSeconds": time.time() - start,
+                             "ticks": stats["ticks"],
+                             "jitterP50Ms": stats["jitterP50"] * 1000,
+                             "jitterP99Ms": stats["jitterP99"] * 1000,
+                             "maxLatenessMs": stats["maxLateness"] * 1000,
+                             "clipsPlayed": audio.played if audio else 0,
+                             "playCallMs": max(playCalls) * 1000 })
+            if (audio != None): audio.close()
+            session.close()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def printAudio(results):
+    print "%6s %8s %8s %8s %8s %6s %11s" % ("audio", "wall s", "ticks",
+        "p50 ms", "p99 ms", "clips", "play() ms")
+    for row in results:
+        print "%6s %8.3f %8d %8.3f %8.3f %6d %11.3f" % (
+            "on" if row["audio"] else "off", row["wallSeconds"], row["ticks"],
+            row["jitterP50Ms"], row["jitterP99Ms"], row["clipsPlayed"],
+            row["playCallMs"])
+
+def benchProfile(repeat=200):
+    # Move time in ticks at the session's peak speeds: the constant step
+    # (what the planner uses by default), a pure trapezoid, and the planner
+    # with the axis in rampedAxes (constant steps for short moves). Then the
+    # cost of planning a scan with a cold and a warm profile cache.
+    session = makeSession()
+    moves = []
+    for (axis, distances) in [("tilt", [2, 5, 15, 30, 55]),
+                              ("pan", [2, 10, 30, 90])]:
+        for distance in distances:
+            (speed, accel) = (session.maxServoStep[axis], session.maxServoAccel[axis])
+            old = GullibotMotion.stepsFor(distance, speed)
+            trapezoid = int(math.ceil(GullibotMotion.trapezoidTicks(
+                distance, speed, accel)[0] - 1e-9))
+            start = session.tiltLimits[0] if (axis == "tilt") else 0
+            planned = len(session.planAxes({ axis: start + distance },
+                                           positions={ axis: start }))
+            session.rampedAxes = set([ axis ])
+            ramped = len(session.planAxes({ axis: start + distance },
+                                          positions={ axis: start }))
+            session.rampedAxes = set()
+            moves.append({ "axis": axis, "distance": distance,
+                           "constantTicks": old, "trapezoidTicks": trapezoid,
+                           "plannedTicks": planned, "rampedTicks": ramped,
+                           "change": float(ramped) / old - 1.0 })
+    cache = GullibotMotion.profileCache
+    session.rampedAxes = set(session.maxServoStep)
+    timings = {}
+    for label in ["cold", "warm"]:
+        start = time.time()
+        for index in xrange(repeat):
+            if (label == "cold"): cache.clear()
+            session.planGesture("scan")
+        timings[label + "ScanPlanMs"] = (time.time() - start) / repeat * 1000
+    timings["numpy"] = GullibotMotion.numpy != None
+    session.close()
+    return { "moves": moves, "planning": timings }
+
+def printProfile(results):
+    print "%-5s %8s %9s %10s %8s %7s %7s" % ("axis", "distance", "constant",
+                                            "trapezoid", "planned", "ramped",
+                                            "change")
+    for row in results["moves"]:
+        print "%-5s %8d %9d %10d %8d %7d %+6.0f%%" % (
+            row["axis"], row["distance"], row["constantTicks"],
+            row["trapezoidTicks"], row["plannedTicks"], row["rampedTicks"],
+            row["change"] * 100)
+    planning = results["planning"]
+    print "Scan plan: %.3f ms cold, %.3f ms cached (numpy: %s)." % (
+        planning["coldScanPlanMs"], planning["warmScanPlanMs"], planning["numpy"])
+
+def benchMotionProcess(sweeps=6, busy=True):
+    # Tick jitter of tilt sweeps with the output loop in this process, and
+    # in a motion process with and without raised priority, while another
+    # thread keeps the session busy (paginating text, as loading does).
+    results = []
+    text = makeText(20000)
+    for mode in ["thread", "process", "process (no priority)"]:
+        if (mode == "thread"):
+            writer = ServoblasterWriter(os.devnull)
+        else:
+            writer = MotionProcess(os.devnull, realtime=(mode == "process"))
+        with Quiet():
+            session = GullibotSession(lcdActive=False, pwm=writer,
+                                      inputFunc=lambda prompt="": "n")
+            session.ensureAssets()
+        stopped = threading.Event()
+        def load():
+            while not stopped.is_set():
+                session.compileScript(text)
+        loader = threading.Thread(target=load)
+        if busy: loader.start()
+        session.motionClock.resetStats()
+        writer.resetCounters()
+        start = time.time()
+        with Quiet():
+            for sweep in xrange(sweeps):
+                session.panOrTilt(["tilt", "150" if (sweep % 2 == 0) else "190"],
+                                  "tilt")
+        wall = time.time() - start
+        stopped.set()
+        if busy: loader.join()
+        if (mode == "thread"):
+            (stats, priority) = (session.motionClock.stats(), "-")
+        else:
+            time.sleep(0.3) # Stats are published every 20 ticks.
+            stats = writer.stats()
+            priority = stats["priority"]
+        results.append({ "mode": mode, "priority": priority, "wallSeconds": wall,
+                         "ticks": stats["ticks"],
+                         "jitterP50Ms": stats["jitterP50"] * 1000,
+                         "jitterP99Ms": stats["jitterP99"] * 1000,
+                         "maxLatenessMs": stats["maxLateness"] * 1000,
+                         "missedDeadlines": stats["missedDeadlines"] })
+        session.close()
+    return results
+
+def printMotionProcess(results):
+    print "%-22s %8s %8s %8s %8s %8s %7s" % ("output loop", "priority", "wall s",
+        "p50 ms", "p99 ms", "max ms", "missed")
+    for row in results:
+        print "%-22s %8s %8.3f %8.3f %8.3f %8.3f %7d" % (
+            row["mode"], row["priority"], row["wallSeconds"], row["jitterP50Ms"],
+            row["jitterP99Ms"], row["maxLatenessMs"], row["missedDeadlines"])
+
+def benchCancel(trials=20, busy=True, seed=2014):
+    # Starts a scan, cancels it at a random moment, and measures the time
+    # until it starts easing to a hold, in ticks; with a busy session
+    # thread, with the output loop in this process and in a motion process.
+    rand = random.Random(seed)
+    text = makeText(20000)
+    results = []
+    for mode in ["thread", "process"]:
+        writer = ServoblasterWriter(os.devnull) if (mode == "thread") else \
+                 MotionProcess(os.devnull)
+        with Quiet():
+            session = GullibotSession(lcdActive=False, pwm=writer,
+                                      inputFunc=lambda prompt="": "n")
+            session.ensureAssets()
+        stopped = threading.Event()
+        def load():
+            while not stopped.is_set():
+                session.compileScript(text)
+        loader = threading.Thread(target=load)
+        if busy: loader.start()
+        with Quiet():
+            for trial in xrange(trials):
+                mover = threading.Thread(target=session.executeCmd,
+                                         args=(["servo", "scan"],))
+                mover.start()
+                time.sleep(rand.uniform(0.1, 2.0))
+                session.stopMotion()
+                mover.join()
+        stopped.set()
+        if busy: loader.join()
+        stats = session.motionJobs.stats()
+        stats["mode"] = mode
+        results.append(stats)
+        session.close()
+    return results
+
+def printCancel(results):
+    print "%-8s %8s %9s %9s %9s %9s" % ("loop", "cancels", "p50 tick",
+                                       "p99 tick", "max tick", "<=2 ticks")
+    for row in results:
+        print "%-8s %8d %9.2f %9.2f %9.2f %8.0f%%" % (
+            row["mode"], row["cancels"], row["latencyP50Ticks"],
+            row["latencyP99Ticks"], row["latencyMaxTicks"],
+            row["withinTwoTicks"] * 100)
+
+def benchRecorder(calls=100000):
+    # Cost per call of the instrumented hot paths with recording off and on,
+    # and what the log costs on disk. The loops record far faster than any
+    # session does, so some events are dropped at the queue bound.
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench.rec")
+    results = {}
+    frames = [ [ ("line %d.%d" % (index, row)).ljust(20) for row in xrange(4) ]
+               for index in xrange(2) ]
+    try:
+        for (label, recorder) in [("off", NullRecorder()),
+                                  ("on", SessionRecorder(path))]:
+            with Quiet():
+                session = GullibotSession(lcdActive=False, recorder=recorder,
+                                          pwm=RecordingPWM(EventLog(maxEvents=16)),
+                                          display=RecordingDisplay(EventLog(maxEvents=16)))
+                session.ensureAssets()
+            setServo = session.setServo
+            start = time.time()
+            for index in xrange(calls):
+                setServo(0, 150 + (index & 1))
+            results[label + "MicrosPerSetServo"] = (time.time() - start) / calls * 1e6
+            show = session.writeToCharDisplay
+            start = time.time()
+            for index in xrange(calls // 10):
+                show(frames[index & 1])
+            results[label + "MicrosPerLcdFrame"] = (time.time() - start) / (calls // 10) * 1e6
+            record = recorder.record
+            start = time.time()
+            for index in xrange(calls):
+                record(3, 0, 150.0)
+            results[label + "MicrosPerRecord"] = (time.time() - start) / calls * 1e6
+            session.close()
+            if recorder.enabled:
+                results["eventsWritten"] = recorder.recorded
+                results["bytesPerEvent"] = recorder.bytesWritten / float(recorder.recorded)
+                events = list(readSession(path))
+                results["eventsRead"] = len(events)
+                results["eventsDropped"] = sum(event[3] for event in events
+                                               if (event[1] == "dropped"))
+    finally:
+        shutil.rmtree(directory)
+    results["setServoOverheadMicros"] = (results["onMicrosPerSetServo"] -
+                                         results["offMicrosPerSetServo"])
+    results["lcdFrameOverheadMicros"] = (results["onMicrosPerLcdFrame"] -
+                                         results["offMicrosPerLcdFrame"])
+    return results
+
+FULL_SCRIPT_ANSWERS = [ "pan 175", "next", "", "", "", "", "n" ]
+
+def replayFullScript(answers=FULL_SCRIPT_ANSWERS):
+    # One scripted session on a SimulatedClock. Returns the device events
+    # (virtual time, device, kind, value) and the virtual seconds it took.
+    clock = SimulatedClock()
+    log = EventLog(now=clock.now)
+    answers = list(answers)
+    def readInput(prompt=""):
+        return answers.pop(0) if answers else "n"
+    with Quiet():
+        session = GullibotSession(pwm=RecordingPWM(log), display=RecordingDisplay(log),
+                                  audio=RecordingAudio(log), inputFunc=readInput,
+                                  recorder=NullRecorder(), clock=clock)
+        session.ensureAssets()
+        session.runFullScript() # Answers "n" at the end: closes the session.
+    return (list(log.events), clock.now())
+
+def benchReplay(runs=200):
+    # Full scripted sessions on virtual time: how many replay per minute,
+    # and whether every replay produces the same timestamped events.
+    (reference, seconds) = replayFullScript()
+    start = time.time()
+    mismatches = 0
+    for run in xrange(runs):
+        (events, virtual) = replayFullScript()
+        if (events != reference) or (virtual != seconds): mismatches += 1
+    wall = time.time() - start
+    kinds = {}
+    for event in reference:
+        kinds[event[1]] = kinds.get(event[1], 0) + 1
+    return { "runs": runs,
+             "virtualSeconds": seconds,
+             "wallMsPerRun": wall / runs * 1000,
+             "sessionsPerMinute": runs * 60.0 / wall,
+             "speedup": seconds * runs / wall,
+             "events": len(reference),
+             "pwmEvents": kinds.get("pwm", 0),
+             "lcdEvents": kinds.get("lcd", 0),
+             "mismatchedRuns": mismatches }
+
+def lcdFrames():
+    # Every page of the script files, in order, as the session shows them.
+    frames = []
+    for name in sorted(os.listdir("script")):
+        if name.endswith(".txt"):
+            with open(os.path.join("script", name)) as data:
+                frames.extend(paginate(data.read(), 20, 4))
+    return frames
+
+def benchLcd(clockHz=100000, perTransaction=50e-6):
+    # lcddriver-style per-byte writes against block writes, on the stand-in
+    # bus: full refreshes (as after lcd_clear) and changed-runs-only updates.
+    # perTransaction models the syscall/Python cost of each bus write.
+    frames = lcdFrames()
+    results = []
+    for full in [ True, False ]:
+        for blockWrites in [ False, True ]:
+            bus = StandInBus(clockHz, perTransaction)
+            buffer = CharFramebuffer(HD44780(bus, blockWrites=blockWrites))
+            bus.resetCounters()
+            correct = 0
+            start = time.time()
+            for frame in frames:
+                if full: buffer.invalidate()
+                buffer.show(frame)
+                if (bus.rows() == buffer.normalize(frame)): correct += 1
+            wall = time.time() - start
+            count = float(len(frames))
+            results.append({ "refresh": "full" if full else "changed",
+                             "path": "block" if blockWrites else "per-byte",
+                             "frames": len(frames),
+                             "lcdBytesPerFrame": buffer.bytesSent / count,
+                             "transactionsPerFrame": bus.transactions / count,
+                             "busBytesPerFrame": bus.bytesSent / count,
+                             "modeledMsPerFrame": bus.modeledSeconds() / count * 1000,
+                             "encodeMsPerFrame": wall / count * 1000,
+                             "framesCorrect": correct })
+    return results
+
+def printLcd(results):
+    print "%-8s %-9s %8s %8s %8s %10s %9s %8s" % (
+        "refresh", "path", "lcdB/fr", "xact/fr", "busB/fr", "modeled ms",
+        "encode ms", "correct")
+    for row in results:
+        print "%-8s %-9s %8.1f %8.1f %8.1f %10.2f %9.3f %5d/%d" % (
+            row["refresh"], row["path"], row["lcdBytesPerFrame"],
+            row["transactionsPerFrame"], row["busBytesPerFrame"],
+            row["modeledMsPerFrame"], row["encodeMsPerFrame"],
+            row["framesCorrect"], row["frames"])
+
+def benchServer(clientCounts=(1, 4), seconds=3.0):
+    # Command round trips to a stand-in robot process, over localhost TCP
+    # and over a Unix socket.
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for transport in [ "tcp", "unix" ]:
+            path = os.path.join(directory, "gullibot.sock")
+            where = [ "--socket", path ] if (transport == "unix") else [ "--port", "0" ]
+            process = subprocess.Popen([ sys.executable, "GullibotServer.py",
+                                         "--standin", "--quiet" ] + where,
+                                       stdout=subprocess.PIPE)
+            try:
+                line = process.stdout.readline() # "Listening on ..."
+                if (transport == "unix"):
+                    address = path
+                else:
+                    (host, port) = line.split()[-1].rsplit(":", 1)
+                    address = (host, int(port))
+                for clients in clientCounts:
+                    row = loadTest(address, clients, seconds)
+                    row["transport"] = transport
+                    results.append(row)
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def printServer(results):
+    print "%-9s %7s %10s %8s %8s %8s %6s" % ("transport", "clients", "cmds/s",
+                                             "p50 ms", "p90 ms", "p99 ms", "fails")
+    for row in results:
+        print "%-9s %7d %10.1f %8.3f %8.3f %8.3f %6d" % (
+            row["transport"], row["clients"], row["commandsPerSecond"],
+            row["latencyP50Ms"], row["latencyP90Ms"], row["latencyP99Ms"],
+            row["failures"])
+
+def checkServer():
+    # Rejected commands must come back ok:false, accepted ones ok:true.
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "gullibot.sock")
+    try:
+        with Quiet():
+            server = UnixCommandServer(standInSession(), path)
+            server.session.ensureAssets()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = CommandClient(path)
+        try:
+            with Quiet():
+                for cmd in [ "tilt 999", "say 99", "pan abc", "light bogus", "servo" ]:
+                    reply = client.request(cmd)
+                    assert not reply["ok"], "%s: %r" % (cmd, reply)
+                    assert reply.get("error", ""), "%s: no error message" % cmd
+                for cmd in [ "light on", "light off", "status" ]:
+                    reply = client.request(cmd)
+                    assert reply["ok"], "%s: %r" % (cmd, reply)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+            server.session.close()
+    finally:
+        shutil.rmtree(directory)
+
+def checkRecorder():
+    # Non-ASCII text, as bytes (console input, script files) and as unicode,
+    # survives the log and the CSV export; bad UTF-8 does not stop the writer.
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "check.rec")
+    try:
+        recorder = SessionRecorder(path, flushInterval=0.01)
+        recorder.record(ANSWER, text="Caf\xc3\xa9")
+        recorder.record(COMMAND, text=u"na\xefve")
+        recorder.record(ANSWER, text="\xff")
+        recorder.flush()
+        assert recorder.thread.is_alive(), "writer thread died"
+        recorder.record(COMMAND, text="after")
+        recorder.close()
+        texts = [ event[4] for event in readSession(path) ]
+        assert (texts == [ u"Caf\xe9", u"na\xefve", u"\ufffd", u"after" ]), repr(texts)
+        output = StringIO.StringIO()
+        assert (exportCsv(path, output) == 4)
+        rows = list(csv.reader(StringIO.StringIO(output.getvalue())))
+        assert ([ row[4] for row in rows[1:] ] ==
+                [ "Caf\xc3\xa9", "na\xc3\xafve", "\xef\xbf\xbd", "after" ]), repr(rows)
+    finally:
+        shutil.rmtree(directory)
+
+def checkBatchStop():
+    # In a batch, "stop" runs in file order: it drops nothing queued before it.
+    output = StringIO.StringIO()
+    (stdout, sys.stdout) = (sys.stdout, output)
+    session = standInSession()
+    try:
+        session.ensureAssets()
+        runBatch(session, StringIO.StringIO("tilt 160\ntilt 170\nstop\ntilt 165\n"),
+                 report=False)
+    finally:
+        sys.stdout = stdout
+        session.close()
+    assert ("dropped" not in output.getvalue()), output.getvalue()
+    assert (session.servoPositions["tilt"] == 165), session.servoPositions
+
+def checkCommandLine():
+    # Options may come before or after the batch file.
+    parser = commandLineParser()
+    for argv in [ [ "batch", "--develop", "cmds.txt" ],
+                  [ "batch", "cmds.txt", "--develop" ] ]:
+        args = parser.parse_args(argv)
+        assert (args.mode, args.file, args.develop) == ("batch", "cmds.txt", True), argv
+    args = parser.parse_args([ "batch" ])
+    assert (args.file == None) and not args.develop
+    args = parser.parse_args([ "control", "--profile", "gullibot.cfg", "--no-lcd" ])
+    assert (args.mode, args.profile, args.lcdActive) == ("control", "gullibot.cfg", False)
+    args = parser.parse_args([ "serve", "--socket", "/tmp/check.sock" ])
+    assert (args.socket == "/tmp/check.sock")
+
+def checkLcdStats():
+    # The framebuffer reports the bus writes HD44780 made; it only estimates
+    # them for displays that do not count (lcddriver, the memory stand-in).
+    frames = lcdFrames()[:5]
+    for blockWrites in [ False, True ]:
+        bus = StandInBus()
+        buffer = CharFramebuffer(HD44780(bus, blockWrites=blockWrites))
+        bus.resetCounters()
+        for frame in frames:
+            buffer.show(frame)
+            assert (buffer.stats()["lastTransactions"] > 0)
+        assert (buffer.stats()["transactions"] == bus.transactions), (
+            blockWrites, buffer.stats(), bus.transactions)
+        if blockWrites: assert (buffer.stats()["transactions"] == len(frames))
+    buffer = CharFramebuffer(MemoryCharDisplay())
+    buffer.show(frames[0])
+    assert (buffer.stats()["transactions"] == buffer.bytesSent * TRANSACTIONS_PER_BYTE)
+
+def checkAudio():
+    # "stop" then "play" cuts off the current clip and plays the new one; a
+    # sink that cannot start skips the clip; a dead worker makes wait() raise.
+    directory = tempfile.mkdtemp()
+    (longClip, shortClip) = (os.path.join(directory, "long.wav"),
+                             os.path.join(directory, "short.wav"))
+    writeTone(longClip, seconds=3.0)
+    writeTone(shortClip, seconds=0.2)
+    players = []
+    try:
+        audio = AudioPlayer([ longClip, shortClip ], sink="null")
+        players.append(audio)
+        assert audio.waitReady()
+        start = time.time()
+        audio.play(longClip)
+        time.sleep(0.3)
+        audio.stop()
+        audio.play(shortClip)
+        assert audio.wait(5.0)
+        assert (time.time() - start < 2.0), "stop did not cut off the clip"
+        assert (audio.played == 2), audio.played
+        if (distutils.spawn.find_executable("aplay") == None):
+            audio = AudioPlayer([ shortClip ], sink="aplay")
+            players.append(audio)
+            assert audio.waitReady()
+            audio.play(shortClip)
+            assert audio.wait(5.0) and audio.process.is_alive()
+            assert audio.errors and ("aplay" in audio.errors[0][1]), audio.errors
+        audio = AudioPlayer([ shortClip ], sink="null")
+        players.append(audio)
+        assert audio.waitReady()
+        audio.process.terminate()
+        audio.process.join()
+        audio.play(shortClip)
+        try:
+            audio.wait(5.0)
+            assert False, "wait() returned with the worker dead"
+        except IOError:
+            pass
+    finally:
+        for audio in players: audio.close()
+        shutil.rmtree(directory)
+
+def checkDisplayPages():
+    # A script message longer than one screen shows every page.
+    clock = SimulatedClock()
+    with Quiet():
+        session = GullibotSession(pwm=RecordingPWM(EventLog()),
+                                  display=RecordingDisplay(EventLog()),
+                                  recorder=NullRecorder(), clock=clock)
+        session.ensureAssets()
+    try:
+        pages = session.compileScript(makeText(60))
+        assert (len(pages) > 1), pages
+        session.messages["greeting"] = pages
+        shown = []
+        session.writeToCharDisplay = shown.append
+        Timeline.compile(session, "display greeting\n").run()
+        assert (shown == pages), (len(shown), len(pages))
+    finally:
+        session.close()
+
+def checkTimelineLeds():
+    # LED names are checked when the timeline is compiled.
+    with Quiet():
+        session = GullibotSession(pwm=RecordingPWM(EventLog()),
+                                  display=RecordingDisplay(EventLog()),
+                                  recorder=NullRecorder(), clock=SimulatedClock())
+        session.ensureAssets()
+    try:
+        Timeline.compile(session, "led scan blink\nled indicator off\n")
+        try:
+            Timeline.compile(session, "led scna blink\n")
+            assert False, "led scna compiled"
+        except TimelineError as error:
+            assert ("scna" in str(error)), error
+    finally:
+        session.close()
+
+CHECKS = [ checkServer, checkRecorder, checkBatchStop, checkCommandLine,
+           checkLcdStats, checkAudio, checkDisplayPages, checkTimelineLeds ]
+
+def runChecks():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+            print "%-24s ok" % check.__name__
+        except AssertionError as error:
+            failures += 1
+            print "%-24s FAILED: %s" % (check.__name__, error)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gullibot benchmarks.")
+    parser.add_argument("which", nargs="?", default="suite",
+                        choices=["suite", "wrap", "trace", "startup", "audio",
+                                 "profile", "motion", "cancel", "record",
+                                 "replay", "lcd", "server", "check"])
+    parser.add_argument("--quick", action="store_true",
+                        help="skip testLEDs and the full script")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args(argv)
+    if (args.which == "check"):
+        sys.exit(1 if runChecks() else 0)
+    if (args.which == "wrap"):
+        results = benchWrap()
+        printWrap(results)
+        report = { "revision": gitRevision(), "wrap": results }
+    elif (args.which == "trace"):
+        report = { "revision": gitRevision(), "trace": benchTrace() }
+        for key in sorted(report["trace"]):
+            print "%-24s %8.3f" % (key, report["trace"][key])
+    elif (args.which == "record"):
+        report = { "revision": gitRevision(), "record": benchRecorder() }
+        for key in sorted(report["record"]):
+            print "%-24s %10.3f" % (key, report["record"][key])
+    elif (args.which == "server"):
+        report = { "revision": gitRevision(), "server": benchServer() }
+        printServer(report["server"])
+    elif (args.which == "lcd"):
+        report = { "revision": gitRevision(), "lcd": benchLcd() }
+        printLcd(report["lcd"])
+    elif (args.which == "replay"):
+        report = { "revision": gitRevision(), "replay": benchReplay() }
+        for key in sorted(report["replay"]):
+            print "%-20s %12.3f" % (key, report["replay"][key])
+    elif (args.which == "cancel"):
+        report = { "revision": gitRevision(), "cancel": benchCancel() }
+        printCancel(report["cancel"])
+    elif (args.which == "motion"):
+        report = { "revision": gitRevision(), "motion": benchMotionProcess() }
+        printMotionProcess(report["motion"])
+    elif (args.which == "profile"):
+        report = { "revision": gitRevision(), "profile": benchProfile() }
+        printProfile(report["profile"])
+    elif (args.which == "audio"):
+        report = { "revision": gitRevision(), "audio": benchAudio() }
+        printAudio(report["audio"])
+    elif (args.which == "startup"):
+        report = { "revision": gitRevision(), "startup": benchStartup() }
+        printStartup(report["startup"])
+    else:
+        report = benchSuite(args.quick)
+        printSuite(report)
+    if args.output:
+        with open(args.output, "w") as data:
+            json.dump(report, data, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
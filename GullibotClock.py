@@ -0,0 +1,159 @@
+"""
+Timing for Gullibot motion.
+
+MotionClock ticks on absolute deadlines (start + n * period) instead of
+sleeping a fixed amount after each step, so the time spent writing to the
+servos does not stretch a gesture. Late ticks are either caught up (run
+back-to-back until on schedule) or skipped (jump to the next future slot).
+
+Sessions take their time from a clock object with now() and sleep():
+SystemClock is the wall clock; SimulatedClock only moves when something
+sleeps on it, and then jumps at once, so a scripted session replays in
+milliseconds with the same timestamps it would have had on the robot.
+"""
+
+import time
+import threading
+import contextlib
+import collections
+
+class SystemClock(object):
+    simulated = False
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class SimulatedClock(object):
+    # Virtual time for replays: sleep() returns at once, having moved now()
+    # on by the time slept. Listeners (e.g. LedEngine.advance) are called
+    # every `step` seconds along the way, as a background thread would be.
+    # Meant for single-threaded runs; every sleeper moves the one clock.
+    simulated = True
+
+    def __init__(self, start=0.0, step=0.01):
+        (self.current, self.step) = (start, step)
+        self.listeners = []
+        self.slept = 0.0
+        self.lock = threading.RLock()
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        with self.lock:
+            end = self.current + max(0.0, seconds)
+            self.slept += end - self.current
+            if self.listeners:
+                while (self.current + self.step < end):
+                    self.current += self.step
+                    for listener in self.listeners: listener(self.current)
+            self.current = end
+            for listener in self.listeners: listener(end)
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+class MotionClock(object):
+    policies = [ "catchup", "skip" ]
+
+    def __init__(self, period=0.01, policy="skip", historySize=2000,
+                 now=time.time, sleep=time.sleep):
+        if (policy not in MotionClock.policies):
+            raise ValueError("Unknown overrun policy: %r" % policy)
+        (self.period, self.policy) = (period, policy)
+        (self.now, self.sleep) = (now, sleep)
+        self.lateness = collections.deque(maxlen=historySize) # Per tick.
+        self.depth = 0
+        self.origin = None
+        self.tickIndex = 0
+        self.resetStats()
+
+    def resetStats(self):
+        self.lateness.clear()
+        self.ticks = 0
+        self.overruns = 0          # Tick work ran past its deadline.
+        self.missedDeadlines = 0   # Whole periods lost to overruns.
+        self.maxLateness = 0.0     # seconds
+
+    def start(self):
+        # Sets the timeline origin; deadlines are counted from here.
+        self.origin = self.now()
+        self.tickIndex = 0
+
+    @contextlib.contextmanager
+    def running(self):
+        # Keeps one timeline across nested gestures (e.g. runScan segments).
+        if (self.depth == 0): self.start()
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if (self.depth == 0): self.origin = None
+
+    def wait(self, ticks=1):
+        # Blocks until the deadline `ticks` periods after the last one.
+        if (self.origin == None): self.start()
+        self.tickIndex += ticks
+        deadline = self.origin + self.tickIndex * self.period
+        remaining = deadline - self.now()
+        if (remaining > 0):
+            self.sleep(remaining)
+        else:
+            self.overruns += 1
+        late = max(0.0, self.now() - deadline)
+        self.record(late)
+        if (late >= self.period):
+            missed = int(late / self.period)
+            self.missedDeadlines += missed
+            if (self.policy == "skip"):
+                self.tickIndex += missed # Next deadline is in the future.
+        return late
+
+    def record(self, late):
+        self.ticks += 1
+        self.lateness.append(late)
+        if (late > self.maxLateness): self.maxLateness = late
+
+    def stats(self):
+        samples = sorted(self.lateness)
+        def percentile(p):
+            if not samples: return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+        return { "ticks": self.ticks,
+                 "overruns": self.overruns,
+                 "missedDeadlines": self.missedDeadlines,
+                 "maxLateness": self.maxLateness,
+                 "jitterP50": percentile(0.50),
+                 "jitterP99": percentile(0.99) }
+
+class PhaseTimer(object):
+    # Wall time per named phase (e.g. of startup); phases may overlap.
+    def __init__(self, now=time.time):
+        self.now = now
+        self.origin = now()
+        self.phases = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.record(name, self.now() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases[name] = seconds
+
+    def mark(self, name):
+        # Records the time from the origin until now.
+        self.record(name, self.now() - self.origin)
+
+    def report(self):
+        with self.lock:
+            return ", ".join("%s %.3f s" % item for item in self.phases.items())
@@ -9,53 +9,179 @@ Gullibot Team:
 """
 
 # General imports here.
-import time
-import os
+import contextlib
+import threading
+import argparse
+import ConfigParser
+
+from GullibotDevices import (ServoblasterWriter, LazyCharDisplay,
+                             EventLog, RecordingPWM)
+from GullibotClock import MotionClock, PhaseTimer, SystemClock
+from GullibotMotion import planProfile, easeSteps
+from GullibotDisplay import CharFramebuffer
+from GullibotAssets import ScriptCatalog
+from GullibotText import paginate
+from GullibotTrace import tracerFromEnvironment, TRACED_METHODS
+import GullibotLEDs
+from GullibotTimeline import Timeline
+from GullibotCommands import defaultRegistry, splitCommands, CommandError
+from GullibotLEDs import LedEngine
+from GullibotAudio import AudioPlayer
+from GullibotRealtime import MotionProcess
+from GullibotJobs import MotionJobs, MotionCancelled
+import GullibotRecorder
+from GullibotRecorder import recorderFromEnvironment
 
 class GullibotSession(object):
+    # Loaded by loadAssets on a background thread during startup.
+    assetNames = [ "scriptPath", "catalog", "adviceEntries", "advicePaths",
+                   "allAdvice", "advicePages", "greeting", "prescan",
+                   "scanning", "evaluating", "closing", "adios", "messages" ]
+
     ### Initialization ###
     def __init__(self, lcdActive=True, audioActive=False, tiltServoActive=True,
-                 panServoActive=True, ledActive=True):
+                 panServoActive=True, ledActive=True,
+                 servoDevice="/dev/servoblaster", pwm=None, display=None,
+                 audio=None, inputFunc=None, tracer=None, audioSink="aplay",
+                 motionProcess=False, recorder=None, clock=None):
+        # pwm, display and audio are device backends (see GullibotDevices);
+        # by default the real hardware is used. inputFunc replaces raw_input.
+        # tracer: a GullibotTrace.Tracer; default is off unless GULLIBOT_TRACE.
+        # audioSink: where the audio worker plays to (see GullibotAudio).
+        # motionProcess: drive servoblaster from a separate process
+        # (GullibotRealtime) instead of this one.
+        # recorder: a GullibotRecorder.SessionRecorder for study data;
+        # default is off unless GULLIBOT_RECORD names a file.
+        # clock: where motion, LED, LCD and recorder times come from
+        # (GullibotClock); a SimulatedClock replays without waiting.
+        self.clock = clock if (clock != None) else SystemClock()
+        if self.clock.simulated and motionProcess:
+            raise ValueError("The motion process runs on real time only.")
+        self.audioSink = audioSink
+        self.startup = PhaseTimer() # Per-phase startup times.
+        self.tracer = tracer if (tracer != None) else tracerFromEnvironment()
+        self.tracer.instrument(self, TRACED_METHODS)
+        self.recorder = recorder if (recorder != None) else \
+                        recorderFromEnvironment(self.clock.now)
         (self.lcdActive, self.audioActive) = (lcdActive, audioActive)
         self.tiltServoActive = tiltServoActive 
         self.panServoActive = panServoActive
         self.ledActive = ledActive
-        self.initCharDisplay()
-#         self.initAudio()
-        self.initServoBasic()       # assign channels for tilt & pan servos
-        if tiltServoActive:
-            self.resetServoPosition("tilt", 170)
-        if panServoActive:
-            self.resetServoPosition("pan", 180) 
-        self.initLED()              # assign channel for indicator LED
-        self.initAdvice()           # read-in all supplied text files
-        self.initOtherMessages()
+        if (pwm == None) and motionProcess:
+            pwm = MotionProcess(servoDevice, period=0.01)
+        elif (pwm == None):
+            pwm = ServoblasterWriter(servoDevice) # Stays open.
+        self.servoWriter = pwm
+        self.operatorInput = inputFunc if (inputFunc != None) else raw_input
+        self.motionClock = MotionClock(period=0.01, now=self.clock.now,
+                                       sleep=self.clock.sleep) # per servo step
+        self.motionJobs = MotionJobs(self.motionClock.period,
+                                     now=self.clock.now) # cancellable
+        self.commands = defaultRegistry() # verb -> CommandSpec
+        self.validCmds = list(self.commands.specs)
+        with self.startup.phase("devices"):
+            self.initCharDisplay(display) # the LCD opens in the background
+            self.initAudio(audio)         # clips decode in the audio process
+        self.startAssets()          # read-in all supplied text files
+        with self.startup.phase("servos"):
+            self.initServoBasic()   # assign channels for tilt & pan servos
+            if tiltServoActive:
+                self.resetServoPosition("tilt", 170)
+            if panServoActive:
+                self.resetServoPosition("pan", 180) 
+        with self.startup.phase("leds"):
+            self.initLED()          # assign channel for indicator LED
+        self.startup.mark("ready")
+
+    def readInput(self, prompt="", read=None):
+        # Operator input; prompt and answer times bracket each pause.
+        # read: raw_input-like function to use instead of operatorInput.
+        self.recorder.record(GullibotRecorder.PROMPT, text=prompt)
+        answer = (read or self.operatorInput)(prompt)
+        self.recorder.record(GullibotRecorder.ANSWER, text=answer)
+        return answer
+
+    def startAssets(self):
+        # Script files load while the servos home; see ensureAssets.
+        self.assetError = None
+        self.assetThread = threading.Thread(target=self.loadAssets, name="assets")
+        self.assetThread.daemon = True
+        self.assetThread.start()
+
+    def loadAssets(self):
+        try:
+            with self.startup.phase("assets"):
+                self.initCatalog()
+                self.initAdvice()
+                self.initOtherMessages()
+        except Exception as error:
+            self.assetError = error
+
+    def ensureAssets(self):
+        # Waits for the background load; re-raises anything it failed with.
+        self.assetThread.join()
+        if (self.assetError != None): raise self.assetError
+
+    def __getattr__(self, name):
+        # Only called for attributes not set yet, e.g. advice during startup.
+        if (name in GullibotSession.assetNames) and ("assetThread" in self.__dict__):
+            if (threading.current_thread() is not self.assetThread):
+                self.ensureAssets()
+                if (name in self.__dict__): return self.__dict__[name]
+        raise AttributeError(name)
+
+    def startupReport(self):
+        self.ensureAssets()
+        if (self.lcd != None) and hasattr(self.lcd, "thread"):
+            self.lcd.thread.join()
+            if (self.lcd.error != None):
+                print "Character display failed to open: %s" % self.lcd.error
+            else:
+                self.startup.record("lcd", self.lcd.openSeconds)
+        print "Startup: %s." % self.startup.report()
             
-    def initCharDisplay(self):
-        if self.lcdActive:
-            import lcddriver
-            self.lcd = lcddriver.lcd()
+    def initCharDisplay(self, display=None):
+        if (display != None):
+            self.lcdActive = True
+            self.lcd = display
+        elif self.lcdActive:
+            self.lcd = LazyCharDisplay()
         else:
             self.lcd = None
         self.lcdLineLength = 20
         self.lcdNumLines = 4
+        # Shadow of the glass, so only changed characters go over I2C.
+        self.frameBuffer = CharFramebuffer(self.lcd, self.lcdNumLines,
+                                           self.lcdLineLength)
     
-#     def initAudio(self):
-#         if self.audioActive:
-#             import pygame
-#             pygame.mixer.init()
-#             BUFFER = 3072
-#             FREQ, SIZE, CHAN = pygame.mixer.get_init()
-#             pygame.mixer.init(FREQ, SIZE, CHAN, BUFFER)
-#         else: pass
+    def initAudio(self, audio=None):
+        self.audioFiles = { 1:"script/audioFake00.wav" } # by advice index
+        if (audio != None):
+            self.audioActive = True
+            self.audio = audio
+        elif self.audioActive:
+            self.audio = AudioPlayer(self.audioFiles.values(), self.audioSink)
+        else:
+            self.audio = None
 
     def initServoBasic(self):
         self.servoChannels = {}
         GullibotSession.initChannel(self.servoChannels, "tilt", 0)
         GullibotSession.initChannel(self.servoChannels, "pan",  1)
         self.servoPositions = { "tilt":170, "pan":180 } # The starting position.
+        # Peak step per tick. Axes in rampedAxes speed up and slow down at
+        # maxServoAccel (per tick per tick) on long moves; see GullibotMotion.
+        # None yet: at these peaks ramps only add time. Cancelled gestures
+        # ease to a hold at maxServoAccel on every axis.
         self.maxServoStep = {"tilt":1, "pan":0.4}
+        self.maxServoAccel = {"tilt":0.25, "pan":0.1}
+        self.rampedAxes = set()
         self.tiltLimits = (145, 200)
+        if hasattr(self.servoWriter, "setEasing"): # Motion process eases itself.
+            for axis in self.servoChannels:
+                (low, high) = self.tiltLimits if (axis == "tilt") else (None, None)
+                self.servoWriter.setEasing(self.servoChannels[axis],
+                                           self.maxServoAccel[axis], low, high)
     
     def resetServoPosition(self, mode, position):
         servoChannel = self.servoChannels.get(mode, None)
@@ -77,75 +203,85 @@ class GullibotSession(object):
             GullibotSession.initChannel(self.ledChannels, "scan", 4)
             ledChannel = self.ledChannels.get("scan", None)
             self.setServo(ledChannel, 0)
+        self.ledLevels = { "indicator":0, "scan":0 } # PWM level per LED.
         self.scanLedIsOn = False
-        # LEDs use servoblaster, too.
+        # LEDs use servoblaster, too. Patterns run on their own timer wheel,
+        # sharing the motion loop's device writes while anything moves.
+        self.leds = LedEngine(self.setLedLevel, self.servoWriter,
+                              period=self.motionClock.period,
+                              now=self.clock.now, sleep=self.clock.sleep)
+        if self.clock.simulated:
+            self.clock.addListener(self.leds.follow) # No thread needed.
+        else:
+            self.leds.startBackground()
+
+    def setLedLevel(self, name, level):
+        # Sets the LED called name ("scan" or "indicator") to a PWM level.
+        self.setServo(self.ledChannels.get(name, None), level)
+        self.ledLevels[name] = level
+        if (name == "scan"): self.scanLedIsOn = (level > 0)
+
+    @contextlib.contextmanager
+    def ledPattern(self, name, steps, active=True):
+        # Runs an LED pattern for the duration of the block, unless inactive
+        # or a pattern is already running on that LED (e.g. an outer gesture).
+        started = active and not self.leds.isRunning(name)
+        if started: self.leds.start(name, steps)
+        try:
+            yield
+        finally:
+            if started: self.leds.stop(name)
     
+    def initCatalog(self):
+        # Lists and reads script/ once; reuses script.bundle when unchanged.
+        self.scriptPath = "script/"
+        self.catalog = ScriptCatalog(self.scriptPath, self.compileScript,
+                                     self.lcdLineLength, self.lcdNumLines)
+        self.catalog.load()
+
+    def compileScript(self, text):
+        # Raw script text -> list of LCD pages (each a list of 4 lines).
+        return list(paginate(text, self.lcdLineLength, self.lcdNumLines))
+
     def initAdvice(self):
         # Verifies advice files and copies into a list.
         # to do.... Initialize audio files.
-        advicePath = "script/"
-        self.getAdviceFiles(advicePath)
+        self.getAdviceFiles(self.scriptPath)
         self.setAdvice()
     
     def initOtherMessages(self):
         # All text files besides advice.
-        scriptPath = "script/"
         scriptTypes = ["greeting", "prescan", "scanning", "evaluating", "closing", "adios"]
         messages = []
         for i in xrange(len(scriptTypes)):
-            rawText = self.loadSingleTextFile(scriptPath, scriptTypes[i])
-            messages.append(self.lcdParser(rawText))
+            entry = self.catalog.find(scriptTypes[i])
+            messages.append(entry["pages"]) # Precompiled LCD pages, all shown.
         self.greeting =     messages[0]
         self.prescan =      messages[1]
         self.scanning =     messages[2]
         self.evaluating =   messages[3]
         self.closing =      messages[4]
         self.adios =        messages[5]
+        self.messages = dict(zip(scriptTypes, messages)) # For timelines.
             
     def loadSingleTextFile(self, scriptPath, prefix):
-        # Takes string and opens 1st file whose filename starts with prefix.
-        (lineLength, numLines) = (self.lcdLineLength, self.lcdNumLines)
-        allPaths = sorted(os.listdir(scriptPath))
-        for i in xrange(len(allPaths)):
-            fileName = allPaths[i]
-            if fileName.startswith(prefix) and fileName.endswith(".txt"):
-                fullPath = scriptPath + fileName
-                with open(fullPath, 'r') as data:
-                    text = data.read()
-                data.closed
-                print fullPath,
-                if (len(text) <= (lineLength * numLines)): # 1st level check.
-                    print "OK!"
-                    return text
-                else:
-                    print "Too long: %d characters." % len(text)
+        # Takes string and returns text of 1st file whose filename starts with prefix.
+        entry = self.catalog.find(prefix)
+        if (entry != None): return entry["text"]
         
     def getAdviceFiles(self, advicePath):
+        # Keyed by position in the sorted listing of script/ ("say 6").
+        self.adviceEntries = self.catalog.findAll("advice")
         self.advicePaths = {}
-        (lineLength, numLines) = (self.lcdLineLength, self.lcdNumLines)
-        allPaths = sorted(os.listdir(advicePath))
-        for i in xrange(len(allPaths)):
-            fileName = allPaths[i]
-            if fileName.startswith("advice") and fileName.endswith(".txt"):
-                fullPath = advicePath + fileName
-                with open(fullPath, 'r') as data:
-                    text = data.read()
-                data.closed
-                print fullPath,
-                if (len(text) <= (lineLength * numLines)): # 1st level check.
-                    self.advicePaths[i] = fullPath
-                    print "OK!"
-                else:
-                    print "Too long: %d characters." % len(text)
+        for key in self.adviceEntries:
+            self.advicePaths[key] = self.adviceEntries[key]["path"]
     
     def setAdvice(self):
         self.allAdvice = {}
-        for key in self.advicePaths:
-            path = self.advicePaths[key]
-            with open(path, 'r') as file:
-                text = file.read()
-            file.closed
-            self.allAdvice[key] = text
+        self.advicePages = {}
+        for key in self.adviceEntries:
+            self.allAdvice[key] = self.adviceEntries[key]["text"]
+            self.advicePages[key] = self.adviceEntries[key]["pages"]
 
     def displayStatus(self):
         for servo in self.servoPositions:
@@ -156,14 +292,23 @@ class GullibotSession(object):
     def run(self):
         self.initControls()
         self.mainLoop()
+
+    def runConcurrent(self):
+        # Like run(), but commands are taken while a gesture is still moving.
+        from GullibotRuntime import SessionRuntime
+        self.initControls()
+        print "Enter 'status' to see servo positions, 'quit' to exit."
+        self.displayStatus()
+        SessionRuntime(self).run()
+        self.close()
     
     def initControls(self):
         print "Controller for Gullibot."
         print "These commands are available:"
         if self.tiltServoActive:
-            self.validCmds = [ "pan", "tilt", "say", "servo", "light" ]
+            self.validCmds = [ "pan", "tilt", "say", "servo", "light", "stop" ]
         else:
-            self.validCmds = [ "pan", "tilt", "say", "light" ]
+            self.validCmds = [ "pan", "tilt", "say", "light", "stop" ]
         print "   ".join(self.validCmds)
  
     def mainLoop(self):
@@ -171,67 +316,48 @@ class GullibotSession(object):
         self.displayStatus()
         while True:
             print
-            cmd = raw_input('>')
-            # Parse, then send parsed cmd to be executed.
-            parsed = GullibotSession.parseCmd(cmd)
-            if (parsed != []) and (parsed[0] in self.validCmds):
-                print "Executing command..."
-                self.executeCmd(parsed)
-                print "Done."
-            else:
-                print "Invalid command."
+            cmd = self.readInput('>')
+            # Parse, then send each parsed cmd to be executed.
+            commands = splitCommands(cmd) # "pan 175; tilt 160"
+            if (commands == []): print "Invalid command."
+            for parsed in commands:
+                if (parsed[0] in self.validCmds):
+                    print "Executing command..."
+                    self.executeCmd(parsed)
+                    print "Done."
+                else:
+                    print "Invalid command."
             self.displayStatus()
 
-    def runFullScript(self):
-        # Contains pre-scripted interaction.
+    def runFullScript(self, protocolPath="protocols/fullscript.txt"):
+        # Contains pre-scripted interaction, read from a timeline file.
+        # Compiled on first use; a bad step is reported before anything moves.
+        timeline = getattr(self, "timeline", None)
+        if (timeline == None) or (timeline.name != protocolPath):
+            self.timeline = timeline = Timeline.load(self, protocolPath)
         self.displayStatus()
-        # Operator aligns robot to participant.
-        print "Enter 'pan XXX' to point to direction XXX."
-        print "Enter 'next' to proceed."
-        self.panControl()
-        # Intro.
-        self.writeToCharDisplay(self.greeting)
-        self.nod(blink=True)
-        print "Just gave greeting."
-        self.waitForOperator()
-        self.writeToCharDisplay(self.prescan)
-        print "Announced intent to scan..."
-        self.waitForOperator()
-        # Scanning motion.
-        self.writeToCharDisplay(self.scanning)
-        print "Running scan."
-        self.runScan()
-        # "Evaluate" posture.
-        self.writeToCharDisplay(self.evaluating)
-        print "Evaluating posture. Waiting 2 seconds."
-        time.sleep(2)
-        self.waitForOperator()
-        # Advice.
-        self.nod(blink=True)
-        self.say(GullibotSession.parseCmd("say 6"))
-        print "Gave advice. Waiting 5 seconds."
-        time.sleep(5)
-        self.waitForOperator()
-        # Exit.
-        self.writeToCharDisplay(self.closing)
-        time.sleep(3)
-        self.nod(blink=False)
-        self.writeToCharDisplay(self.adios)
-        print "SCRIPT COMPLETE!"
-        print "Go pick-up the robot!"
+        timeline.run()
         self.promptRestart()
     
     def promptRestart(self):
         while True:
             print
-            willRestart = raw_input("Start script from beginning? [y,n]")
+            willRestart = self.readInput("Start script from beginning? [y,n]")
             if (willRestart.lower() in ["y", "n"]): break
         if (willRestart == "y"):
             self.resetServoPosition("tilt", 165)
             self.resetServoPosition("pan", 180)
             self.runFullScript()
         else: 
+            self.close()
             print "Session closed."
+
+    def close(self):
+        self.leds.close()
+        if hasattr(self.audio, "close"): self.audio.close()
+        self.servoWriter.close()
+        self.tracer.finish() # Writes the trace file, if tracing.
+        self.recorder.close()
         
     @staticmethod
     def parseCmd(cmd):
@@ -240,44 +366,35 @@ class GullibotSession(object):
         # "modifier" can be the amount to move, which advice to give, etc.
         return cmd.lower().split() # For now.
 
-    def executeCmd(self, parsed):
-        # Takes parsed string command and calls the relevant function.
-#         print "Command received:", parsed
-        if (len(parsed) == 2) and (parsed[0] == "pan"):
-            print "Rotating body"
-            # do the rotation
-            self.panOrTilt(parsed, "pan")
-        elif (len(parsed) == 2) and (parsed[0] == "tilt"):
-            print "Tilting head"
-            # do the tilt
-            self.panOrTilt(parsed, "tilt")
-        elif (len(parsed) == 2) and (parsed[0] == "say"):
-            # display/voice words
-            self.say(parsed)
-        elif (parsed[0] == "servo") and (parsed[1] == "scan"):
-            print "Calling both servos!!!"
-            # rotate right / left
-            self.runScan()
-        elif (len(parsed) == 2) and (parsed[0] == "light"):
-            print "Controlling LEDs"
-            self.light(parsed)
-        else:
-            print "Invalid command."
+    def executeCmd(self, parsed, validated=None):
+        # Takes parsed string command and calls the relevant function,
+        # after checking it against the command table (GullibotCommands),
+        # unless validated (spec, values) are passed in.
+        self.recorder.record(GullibotRecorder.COMMAND, text=" ".join(parsed))
+        try:
+            self.commands.execute(self, parsed, validated)
+        except CommandError as error:
+            print "Invalid command.", error
+        except MotionCancelled:
+            self.recorder.record(GullibotRecorder.CANCEL, text=" ".join(parsed))
+            print "Stopped. Holding at %s." % ", ".join(
+                "%s %d" % item for item in sorted(self.servoPositions.items()))
     
     def waitForOperator(self):
         # Used for pauses in script.
         while True:
-            entry = raw_input("Press ENTER to continue.")
+            entry = self.readInput("Press ENTER to continue.")
             break
         channel = self.servoChannels.get("tilt", None)
         if (channel != None):
-            self.setServo(channel, self.servoPositions["tilt"]) # Keeps robot from nodding off.
+            # Keeps robot from nodding off, so resend even if unchanged.
+            self.setServo(channel, self.servoPositions["tilt"], force=True)
     
     def panControl(self):
         # Condensed version of initControls & mainloop.
         self.validCmds = [ "pan", "next" ]
         while True:
-            cmd = raw_input('>')
+            cmd = self.readInput('>')
             # Parse, then send parsed cmd to be executed.
             if (cmd == "next"):
                 break
@@ -313,68 +430,211 @@ class GullibotSession(object):
     def smoothServo(self, mode, target, overrideSpeed=None, blink=False):
         # Breaks servo motion up into multiple steps.
         # If an overrideSpeed is given, use that as the servo step.
+        if (overrideSpeed == None):
+            maxStepSize = self.maxServoStep.get(mode, None)
+        else:
+            maxStepSize = overrideSpeed
+        self.moveAxes({mode: target}, {mode: maxStepSize}, blink=blink)
+
+    def moveAxes(self, targets, rates=None, sync=True, blink=False):
+        # Moves several channels (servo or LED names) together, one frame per
+        # motion clock tick. rates (peak speeds) default to maxServoStep;
+        # axes without a rate (e.g. LEDs) follow linearly, or jump when not
+        # synced. With sync=True all axes finish together, otherwise each
+        # moves at its own rate.
+        frames = self.planAxes(targets, rates, sync)
+        with self.motionJobs.job("move"), \
+             self.ledPattern("scan", GullibotLEDs.blink(), blink):
+            self.playFrames(frames)
+
+    def planAxes(self, targets, rates=None, sync=True, positions=None):
+        # Frames for moveAxes, starting from positions (default: current).
+        if (rates == None): rates = self.maxServoStep
+        if (positions == None):
+            positions = dict(self.servoPositions)
+            positions.update(self.ledLevels)
         (tiltMin, tiltMax) = self.tiltLimits
-        if ((mode == "tilt") and ((target < tiltMin) or (target > tiltMax))): return
-        channel = self.servoChannels.get(mode, None)
-        position = self.servoPositions.get(mode, None)
-        blinkTime =  0.1  # seconds
-        servoSleep = 0.01 # seconds
-        timingRatio = int(round(blinkTime / servoSleep)) # used with blinkCount
-        if ((channel != None) and (position != None)):
-            if (overrideSpeed == None):
-                if   (mode == "tilt"): maxStepSize = self.maxServoStep["tilt"]
-                elif (mode == "pan"):  maxStepSize = self.maxServoStep["pan"]
-            else:
-                maxStepSize = overrideSpeed
-            sign = +1 if (target > position) else -1
-            blinkCount = 0
-            while (abs(target - position) > maxStepSize):
-                if (blinkCount == timingRatio):
-                    if blink: self.switchLED()
-                    blinkCount = 0
-                thisTarget = position + sign * maxStepSize
-                self.setServo(channel, thisTarget)
-                time.sleep(servoSleep)
-                position = thisTarget
-                self.servoPositions[mode] = position
-                blinkCount += 1
-            self.setServo(channel, target) # Final bump to target.
-            self.servoPositions[mode] = target
+        target = targets.get("tilt", None)
+        if ((target != None) and ((target < tiltMin) or (target > tiltMax))):
+            targets = dict(targets)
+            del targets["tilt"]
+        starts = {}
+        for axis in targets:
+            if (axis in self.servoChannels) or (axis in self.ledChannels):
+                starts[axis] = positions.get(axis, None)
+        # Profiles never overshoot, so tilt stays within limits.
+        return planProfile(starts, targets, rates, self.maxServoAccel, sync,
+                           self.rampedAxes)
+
+    def playFrames(self, frames):
+        # Sends one frame per motion clock tick, tracking positions. If the
+        # motion job is cancelled, eases to a hold and raises MotionCancelled.
+        if hasattr(self.servoWriter, "schedule"):
+            return self.playFramesRemote(frames)
+        clock = self.motionClock # Steps on absolute deadlines, not sleeps.
+        jobs = self.motionJobs
+        (previous, current) = (dict(self.servoPositions), dict(self.servoPositions))
+        with clock.running():
+            for index in xrange(len(frames)):
+                if jobs.cancelled(): # Checked every tick.
+                    self.easeToHold(previous, current)
+                    raise MotionCancelled()
+                self.writeFrame(frames[index])
+                (previous, current) = (current, dict(self.servoPositions))
+                if (index < len(frames) - 1): clock.wait()
+
+    def writeFrame(self, frame):
+        with self.servoWriter.tick(): # One device write per frame.
+            self.leds.advance() # LED changes due this tick.
+            for axis in frame:
+                if (axis in self.servoChannels):
+                    self.setServo(self.servoChannels[axis], frame[axis])
+                    self.servoPositions[axis] = frame[axis]
+                else:
+                    self.setServo(self.ledChannels[axis], frame[axis])
+                    self.ledLevels[axis] = frame[axis]
+
+    def easeFrames(self, previous, current):
+        # Frames that slow each servo from its last step (previous -> current)
+        # to a stop at maxServoAccel; the last one is the hold position.
+        columns = {}
+        for axis in current:
+            if (axis in self.servoChannels) and (previous.get(axis) != None):
+                (low, high) = self.tiltLimits if (axis == "tilt") else (None, None)
+                columns[axis] = easeSteps(current[axis], current[axis] - previous[axis],
+                                          self.maxServoAccel.get(axis), low, high)
+        numFrames = max([ 0 ] + [ len(column) for column in columns.values() ])
+        return [ dict((axis, columns[axis][min(index, len(columns[axis]) - 1)])
+                      for axis in columns if columns[axis])
+                 for index in xrange(numFrames) ]
+
+    def easeToHold(self, previous, current):
+        # Plays the easing frames right away (this tick), not cancellable.
+        clock = self.motionClock
+        frames = self.easeFrames(previous, current)
+        for index in xrange(len(frames)):
+            self.writeFrame(frames[index])
+            if (index == 0): self.motionJobs.stopped()
+            if (index < len(frames) - 1): clock.wait()
+        self.motionJobs.stopped() # Already holding, if nothing moved.
+
+    def holdFor(self, seconds):
+        # A gesture pause that a cancel can cut short.
+        clock = self.motionClock
+        for tick in xrange(max(1, int(round(seconds / clock.period)))):
+            if self.motionJobs.cancelled():
+                self.motionJobs.stopped()
+                raise MotionCancelled()
+            clock.wait()
+
+    def stopMotion(self):
+        # Cancels the running gesture; it eases to a hold on the next tick.
+        if (self.motionJobs.cancel() == None): print "Nothing is moving."
     
+    def playFramesRemote(self, frames):
+        # Hands all frames to the motion process, which plays them on its own
+        # clock, then follows along until the last one has gone out.
+        writer = self.servoWriter
+        channels = dict(self.ledChannels)
+        channels.update(self.servoChannels)
+        channelFrames = []
+        for frame in frames:
+            channelFrames.append(dict((channels[axis], frame[axis]) for axis in frame
+                                      if (channels.get(axis) != None)))
+        lastTick = writer.schedule(channelFrames)
+        while not writer.waitFor(lastTick, timeout=self.motionClock.period / 2):
+            if self.motionJobs.cancelled(): self.cancelRemote()
+            self.readRemotePositions() # Where the servos are now.
+        if frames:
+            for axis in frames[-1]:
+                if (axis in self.servoChannels): self.servoPositions[axis] = frames[-1][axis]
+                else: self.ledLevels[axis] = frames[-1][axis]
+        if (self.motionClock.origin != None):
+            self.motionClock.start() # Later pauses count from here.
+
+    def readRemotePositions(self):
+        for axis in self.servoPositions:
+            if (self.servoChannels.get(axis) != None):
+                self.servoPositions[axis] = self.servoWriter.position(self.servoChannels[axis])
+
+    def cancelRemote(self):
+        # The motion process drops the queued frames and eases to a hold on
+        # its next tick (see setEasing in initServoBasic).
+        writer = self.servoWriter
+        count = writer.cancel()
+        self.motionJobs.stopped(writer.waitCancelled(count))
+        self.readRemotePositions()
+        if (self.motionClock.origin != None): self.motionClock.start()
+        raise MotionCancelled()
+
     def switchLED(self):
         # Used for blinking during scan motion.
-        ledChannel = self.ledChannels.get("scan", None)
         if (self.scanLedIsOn):
-            self.setServo(ledChannel, 0)
+            self.setLedLevel("scan", 0)
         else:
-            self.setServo(ledChannel, 220)
-        self.scanLedIsOn = not self.scanLedIsOn
+            self.setLedLevel("scan", 220)
+
+    def gestureSegments(self, name, positions):
+        # Scripted gestures as ("move", targets, rates, sync) / ("pause",
+        # seconds). Moves with sync=False run each axis at its own rate.
+        tiltPos = positions.get("tilt", None)
+        panPos = positions.get("pan", None)
+        (tiltMin, tiltMax) = self.tiltLimits
+        segments = []
+        if (name == "scan") and (tiltPos != None) and (panPos != None):
+            # The original scan's moves, each at its own speed; where a tilt
+            # move and a pan move were back to back, they now run together.
+            for loop in xrange(2):
+                segments.append(("move", {"tilt":tiltPos-10, "pan":panPos-7},
+                                 {"tilt":1, "pan":0.2}, False))
+                segments.append(("move", {"pan":panPos+7}, {"pan":0.2}, False))
+                segments.append(("move", {"tilt":tiltPos, "pan":panPos},
+                                 {"tilt":0.4, "pan":0.2}, False))
+                segments.append(("pause", 0.5))
+                segments.append(("move", {"tilt":tiltPos-15}, {"tilt":0.2}, False))
+                segments.append(("pause", 0.5))
+                segments.append(("move", {"tilt":tiltPos}, {"tilt":0.4}, False))
+        elif (name == "nod") and (tiltPos != None):
+            segments.append(("move", {"tilt":max(tiltPos-5, tiltMin)}, {"tilt":0.6}, True))
+            segments.append(("move", {"tilt":tiltPos}, {"tilt":0.4}, True))
+        return segments
+
+    def planGesture(self, name, positions=None):
+        # Precomputes a gesture: (start positions, [("frames", frames) or
+        # ("pause", seconds)]). The plan is only valid from those positions.
+        if (positions == None): positions = dict(self.servoPositions)
+        starts = dict(positions)
+        positions = dict(positions)
+        plan = []
+        for segment in self.gestureSegments(name, positions):
+            if (segment[0] == "pause"):
+                plan.append(segment)
+            else:
+                (kind, targets, rates, sync) = segment
+                frames = self.planAxes(targets, rates, sync, positions)
+                if frames: positions.update(frames[-1])
+                plan.append(("frames", frames))
+        return (starts, plan)
+
+    def playGesture(self, name, blink=False, planned=None):
+        # Runs a gesture, from a precomputed plan if it starts where we are.
+        if (planned == None) or (planned[0] != self.servoPositions):
+            planned = self.planGesture(name)
+        clock = self.motionClock # Segments and pauses share one timeline.
+        with self.motionJobs.job(name), clock.running(), \
+             self.ledPattern("scan", GullibotLEDs.blink(), blink):
+            for (kind, value) in planned[1]:
+                if (kind == "pause"): self.holdFor(value)
+                else: self.playFrames(value)
     
     def runScan(self):
         # Scripted behavior for running posture scan.
-        tiltPos = self.servoPositions.get("tilt", None)
-        panPos = self.servoPositions.get("pan", None)
-        if ((tiltPos != None) and (panPos != None)):
-            for loop in xrange(2):
-                self.smoothServo("tilt", tiltPos-10, blink=True)
-                self.smoothServo("pan",  panPos-7,   overrideSpeed=0.2, blink=True)
-                self.smoothServo("pan",  panPos+7,   overrideSpeed=0.2, blink=True)
-                self.smoothServo("pan",  panPos,     overrideSpeed=0.2, blink=True)
-                self.smoothServo("tilt", tiltPos,    overrideSpeed=0.4, blink=True)
-                time.sleep(0.5)
-                self.smoothServo("tilt", tiltPos-15, overrideSpeed=0.2, blink=True)
-                time.sleep(0.5)
-                self.smoothServo("tilt", tiltPos,    overrideSpeed=0.4, blink=True)
+        # Blinks through the pauses too, on its own 0.2 s period.
+        self.playGesture("scan", blink=True)
     
     def nod(self, blink=False):
         # Scripted behavior for small nod motion.
-        tiltPos = self.servoPositions.get("tilt", None) # Starting position
-        (tiltMin, tiltMax) = self.tiltLimits
-        if (tiltPos != None):
-            for loop in xrange(1):
-                self.smoothServo("tilt", max(tiltPos-5, tiltMin),
-                                 overrideSpeed=0.6, blink=blink)
-                self.smoothServo("tilt", tiltPos, overrideSpeed=0.4, blink=blink)
+        self.playGesture("nod", blink)
         
     def say(self, parsed):
         # Takes parsed cmd and initiates robot activity.
@@ -383,48 +643,45 @@ class GullibotSession(object):
         # call to character display / text-to-speech
         if (advice != None):
             print "Delivering text/speech:"
-            lcdText = self.lcdParser(advice)
-            self.writeToCharDisplay(lcdText)
             if (self.audioActive != False):
-                self.audioSay(adviceIndex)
+                self.audioSay(adviceIndex) # Plays on while the text shows.
             else:
                 print "If audio were active, file %d would play." % adviceIndex
+            self.showPages(self.advicePages[adviceIndex]) # Precompiled.
         else: print "Invalid number for 'say' command."
     
     def writeToCharDisplay(self, text):
         # Takes list of length 4, each item is a string of length 20 chars.
-        lcd = self.lcd
-        for index in xrange(len(text)):
-            line = text[index]
-            if (self.lcdActive): lcd.lcd_display_string(line, index + 1)
-            else: print line # Allows testing without character display.
+        self.recorder.record(GullibotRecorder.LCD, text="\n".join(text))
+        if (self.lcdActive):
+            self.frameBuffer.show(text) # Sends only what changed.
+        else:
+            for line in text: print line # Allows testing without display.
     
+    def showPages(self, pages, pageTime=3.0):
+        # Shows each LCD page in turn, pageTime seconds apart.
+        for index in xrange(len(pages)):
+            if (index > 0): self.clock.sleep(pageTime)
+            self.writeToCharDisplay(pages[index])
+
     def audioSay(self, adviceIndex):
+        filename = self.audioFiles.get(adviceIndex, None)
+        if (filename == None):
+            print "No audio file for advice %d." % adviceIndex
+            return
+        self.recorder.record(GullibotRecorder.AUDIO, adviceIndex, text=filename)
         try:
-           initMixer()
-           if (adviceIndex == 1): filename = "script/audioFake00.wav"
-           #elif (adviceIndex == 2): filename = "needhug.wav" 
-           playmusic(filename)
-        except KeyboardInterrupt:	# to stop playing, press "ctrl-c"
-           stopmusic()
-           print "\nPlay Stopped by user"
-        except Exception:
-           print "unknown error"
-    
-    def playMusic(self, soundfile):
-        pygame.init()
-        pygame.mixer.init()
-        clock = pygame.time.Clock()
-        pygame.mixer.music.load(soundfile)
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy():
-            clock.tick(1000)
+            self.audio.play(filename) # Returns at once for AudioPlayer.
+        except Exception as error:
+            print "Audio error:", error
     
     def light(self, parsed):
         # Takes parsed cmd and turns LEDs on and off.
-        switch = parsed[1] # "on" or "off" or "test"
+        switch = parsed[1] # "on", "off", "test", "blink", "fade" or "pulse"
         ledChannel = self.ledChannels.get("indicator", None) # Only single LED
         scanLedCh = self.ledChannels.get("scan", None)
+        patterns = { "blink":GullibotLEDs.blink(), "fade":GullibotLEDs.fade(100, 220),
+                     "pulse":GullibotLEDs.pulse() }
         if ((ledChannel != None) and (switch == "on")):
             # Turn LED on
             print "Setting LED to ON."
@@ -437,77 +694,46 @@ class GullibotSession(object):
             # Test two LEDs
             print "Testing two LEDs."
             self.testLEDs()
+        elif ((scanLedCh != None) and (switch in patterns)):
+            print "Scan LED pattern: %s ('light off' stops it)." % switch
+            self.leds.start("scan", patterns[switch])
         elif (ledChannel == None):
             print "LED channel not assigned."
             return
         else:
-            print "Light command either 'on' or 'off'."
+            print "Light command either 'on', 'off', 'blink', 'fade' or 'pulse'."
             return
     
     def indicatorOn(self, onTime=2):
         # From LEDcontrol.py time in seconds
-        ledChannel1 = self.ledChannels.get("scan", None)
-        self.setServo(ledChannel1, 220)
+        self.leds.stop("scan", 220)
     
     def indicatorOff(self):
-        ledChannel = self.ledChannels.get("scan", None)
-        self.setServo(ledChannel, 0)
+        self.leds.stop("scan", 0)
     
     def testLEDs(self):
-        ledChannel1 = self.ledChannels.get("indicator", None)
-        ledChannel2 = self.ledChannels.get("scan", None)
-        self.indicatorOn()
-        # Use 1st version (full on/off blink)
-        for blink in xrange(20):
-            self.setServo(ledChannel2, 0)
-            time.sleep(0.1)
-            self.setServo(ledChannel2, 220)
-            time.sleep(0.1)
-        self.indicatorOff()
-        time.sleep(0.5)
-        for blink in xrange(20):
-            self.setServo(ledChannel2, 100)
-            time.sleep(0.1)
-            self.setServo(ledChannel1, 220)
-            self.setServo(ledChannel2, 220)
-            time.sleep(0.1)
-        self.setServo(ledChannel1, 0)
-        self.setServo(ledChannel2, 0)
+        # Runs as LED patterns, so it returns right away (8.5 s of blinking).
+        # Full on/off blinks, a pause, then half/full blinks with indicator on.
+        flash = [ (0, 0.1), (220, 0.1) ] * 20
+        half = [ (100, 0.1), (220, 0.1) ] * 20
+        self.leds.start("scan", flash + [ (0, 0.5) ] + half, repeat=1)
+        self.leds.start("indicator", [ (0, 4.6), (220, 3.9) ], repeat=1)
     
     def blinkLED(self):
-        ledChannel = self.ledChannels.get("scan", None)
-        for blink in xrange(10):
-            self.setServo(ledChannel, 0)
-            time.sleep(0.1)
-            self.setServo(ledChannel, 220)
-            time.sleep(0.1)
-        self.setServo(ledChannel, 0)
+        self.leds.start("scan", [ (0, 0.1), (220, 0.1) ], repeat=10)
     
     def lcdParser(self, text):
         # Takes (possibly multiline) string. Returns list of strings.
-        lines = []
-        text = text.replace("\n", " ")
-        words = text.split(" ")
-        for line in xrange(self.lcdNumLines):
-            thisLine = []
-            lineLength = 0
-            while True:
-                if len(words) > 0: wordLength = len(words[0])
-                else: break
-                if (lineLength + wordLength) <= self.lcdLineLength:
-                    # ... accounting for final space.
-                    thisLine.append(words.pop(0))
-                    lineLength += (wordLength + 1)
-                else: break
-            lineString = " ".join(thisLine).strip().ljust(20)
-            lines.append(lineString)
-        return lines
-
-    def setServo(self, servoChannel, position):
+        # Only the first screen; see GullibotText.paginate for the rest.
+        return next(paginate(text, self.lcdLineLength, self.lcdNumLines))
+
+    def setServo(self, servoChannel, position, force=False):
         # Source: http://raspberrypi-aa.github.io/session2/pwm-servo.html
-        servoStr ="%u=%u\n" % (servoChannel, position)
-        with open("/dev/servoblaster", "wb") as f:
-            f.write(bytearray(servoStr, 'UTF-8'))
+        # Unchanged values are dropped; writes inside servoWriter.tick() are
+        # sent together. force=True resends even if the value is unchanged.
+        if (servoChannel == None): return # e.g. LEDs not connected.
+        self.recorder.record(GullibotRecorder.SERVO, servoChannel, position)
+        self.servoWriter.write(servoChannel, position, force)
 
     def testLCDParser(self):
         print "\nTesting lcdParser()...",
@@ -529,24 +755,63 @@ class GullibotSession(object):
             assert( self.lcdParser(texts[i]) == results[i] )
         print "OK!"
 
+    def testFrameBuffer(self):
+        print "Testing CharFramebuffer...",
+        from GullibotDisplay import MemoryCharDisplay
+        glass = MemoryCharDisplay(self.lcdNumLines, self.lcdLineLength)
+        frameBuffer = CharFramebuffer(glass, self.lcdNumLines, self.lcdLineLength)
+        frame1 = self.lcdParser("Hello! My name is Alex.")
+        frame2 = self.lcdParser("Hello! My name is Bob.")
+        frameBuffer.invalidate()
+        assert( frameBuffer.show(frame1) == 4 * 21 ) # Full first frame.
+        assert( glass.rows() == frame1 )
+        assert( frameBuffer.show(frame2) < 10 )      # Only "Bob." changes.
+        assert( glass.rows() == frame2 )
+        assert( frameBuffer.show(frame2) == 0 )
+        print "OK!"
+
     def testAll(self):
         self.testLCDParser()
+        self.testFrameBuffer()
+
+# Hardware profile keys (in gullibot.cfg [hardware]) -> session arguments.
+PROFILE_KEYS = [ ("lcd", "lcdActive"), ("audio", "audioActive"),
+                 ("tilt", "tiltServoActive"), ("pan", "panServoActive"),
+                 ("leds", "ledActive"), ("motion-process", "motionProcess") ]
 
-def runScript():
-    session = GullibotSession(lcdActive=True, audioActive=False,
-                              tiltServoActive=True, panServoActive=True,
-                              ledActive=True)
+def loadProfile(path=None, overrides=None):
+    # Returns session arguments from a profile file, then overrides (flags).
+    profile = { "lcdActive":True, "audioActive":False, "tiltServoActive":True,
+                "panServoActive":True, "ledActive":True, "motionProcess":False }
+    if (path != None):
+        config = ConfigParser.SafeConfigParser()
+        if not config.read(path):
+            raise IOError("Cannot read hardware profile %s" % path)
+        for (key, argument) in PROFILE_KEYS:
+            if config.has_option("hardware", key):
+                profile[argument] = config.getboolean("hardware", key)
+    for (argument, value) in (overrides or {}).items():
+        if (value != None): profile[argument] = value
+    return profile
+
+def runScript(profile=None):
+    if (profile == None): profile = loadProfile()
+    session = GullibotSession(**profile)
+    session.startupReport()
     session.testAll()
     session.runFullScript()
 
-def runControl():
-    (lcdActive, audioActive, tiltServoActive, panServoActive, ledActive) = runSetup()
-    print (lcdActive, audioActive, tiltServoActive, panServoActive, ledActive)
-    audioActive = False # Did not work with PWM servo control.
-    session = GullibotSession(lcdActive, audioActive, tiltServoActive,
-                              panServoActive, ledActive)
+def runControl(profile=None):
+    if (profile == None):
+        (lcdActive, audioActive, tiltServoActive, panServoActive, ledActive) = runSetup()
+        print (lcdActive, audioActive, tiltServoActive, panServoActive, ledActive)
+        profile = { "lcdActive":lcdActive, "tiltServoActive":tiltServoActive,
+                    "panServoActive":panServoActive, "ledActive":ledActive }
+        profile["audioActive"] = False # Did not work with PWM servo control.
+    session = GullibotSession(**profile)
+    session.startupReport()
     session.testAll()
-    session.run()
+    session.runConcurrent()
 
 def runSetup():
     while True:
@@ -569,12 +834,45 @@ def runSetup():
     return list(results)
 
 def runDevelop():
+    # Servo and LED writes go to an in-memory log instead of servoblaster.
     session = GullibotSession(lcdActive=False, audioActive=False,
                               tiltServoActive=False, panServoActive=False,
-                              ledActive=False)
+                              ledActive=False, pwm=RecordingPWM(EventLog()))
+    session.startupReport()
     session.testAll()
     session.run()
 
+def runBatchMode(path=None, develop=False, profile=None):
+    # Runs commands from a file (or stdin) without prompting between them.
+    from GullibotCommands import runBatch
+    if develop:
+        session = GullibotSession(lcdActive=False, audioActive=False,
+                                  tiltServoActive=False, panServoActive=False,
+                                  ledActive=False, pwm=RecordingPWM(EventLog()),
+                                  recorder=(profile or {}).get("recorder"))
+    else:
+        session = GullibotSession(**(profile or {}))
+    session.initControls()
+    stream = open(path, 'r') if (path != None) else None
+    try:
+        runBatch(session, stream)
+    finally:
+        if (stream != None): stream.close()
+        session.close()
+
+def runServe(profile=None, socketPath="/tmp/gullibot.sock"):
+    # Takes commands from GullibotServer clients instead of the console.
+    from GullibotServer import UnixCommandServer
+    session = GullibotSession(**(profile or {}))
+    session.startupReport()
+    server = UnixCommandServer(session, socketPath)
+    print "Listening on %s" % server.server_address
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        session.close()
+
 def promptMode():
     modeInstructions = """\
 Select mode:
@@ -589,6 +887,50 @@ Select mode:
     elif (userInput == "control"): runControl()
     else: runDevelop()
 
+def commandLineParser():
+    # One subcommand per mode, each taking the shared options after it, so
+    # "batch --develop FILE" and "batch FILE --develop" both parse.
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--profile",
+                         help="hardware profile, e.g. gullibot.cfg (no setup questions)")
+    options.add_argument("--record", metavar="FILE",
+                         help="record the session for study data (GullibotRecorder)")
+    for (key, argument) in PROFILE_KEYS:
+        options.add_argument("--" + key, dest=argument, action="store_const",
+                             const=True, help="%s is connected" % key)
+        options.add_argument("--no-" + key, dest=argument, action="store_const",
+                             const=False, help="%s is not connected" % key)
+    parser = argparse.ArgumentParser(description="Gullibot controller.")
+    modes = parser.add_subparsers(dest="mode")
+    for mode in [ "script", "control", "develop" ]:
+        modes.add_parser(mode, parents=[ options ])
+    batch = modes.add_parser("batch", parents=[ options ])
+    batch.add_argument("file", nargs="?",
+                       help="command file for batch mode (default stdin)")
+    batch.add_argument("--develop", action="store_true",
+                       help="batch mode without the robot")
+    serve = modes.add_parser("serve", parents=[ options ])
+    serve.add_argument("--socket", default="/tmp/gullibot.sock",
+                       help="Unix socket for serve mode (see GullibotServer)")
+    return parser
+
+def main(argv):
+    # With no mode, asks for one (and for the hardware, in control mode).
+    if not argv:
+        promptMode()
+        return
+    parser = commandLineParser()
+    args = parser.parse_args(argv)
+    overrides = dict((argument, getattr(args, argument))
+                     for (key, argument) in PROFILE_KEYS)
+    profile = loadProfile(args.profile, overrides)
+    if args.record: profile["recorder"] = GullibotRecorder.SessionRecorder(args.record)
+    if (args.mode == "script"): runScript(profile)
+    elif (args.mode == "control"): runControl(profile)
+    elif (args.mode == "develop"): runDevelop()
+    elif (args.mode == "serve"): runServe(profile, args.socket)
+    else: runBatchMode(args.file, args.develop, profile)
+
 if __name__ == "__main__":
-    promptMode()
-   
\ No newline at end of file
+    import sys
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+"""
+Operator command table for Gullibot.
+
+Each command is a CommandSpec: its verb, typed arguments and the session
+method that runs it. CommandRegistry checks a parsed command against the
+table (argument count, type, range) before anything runs, so a bad command
+is rejected with a message instead of failing halfway. A line may hold
+several commands separated by ';', e.g. "pan 175; tilt 160; say 3".
+
+runBatch streams commands from a file (or stdin) into a SessionRuntime, so
+motion commands queue up back to back with no prompt in between, and
+reports commands per second and the per-command validation cost.
+"""
+
+import sys
+import time
+import collections
+
+class CommandError(ValueError):
+    pass
+
+class Arg(object):
+    # One typed argument. kind: "number", "int" or "choice".
+    def __init__(self, name, kind, choices=None, limits=None):
+        (self.name, self.kind) = (name, kind)
+        self.choices = choices # for "choice": list, or callable(session)
+        self.limits = limits   # for numbers: (low, high), or callable(session)
+
+    def convert(self, session, word):
+        if (self.kind == "choice"):
+            choices = self.choices(session) if callable(self.choices) else self.choices
+            if (word not in choices):
+                raise CommandError("%s must be one of: %s." %
+                                   (self.name, ", ".join(str(c) for c in choices)))
+            return word
+        try:
+            value = int(word) if (self.kind == "int") else float(word)
+        except ValueError:
+            raise CommandError("%s must be a number, not '%s'." % (self.name, word))
+        limits = self.limits(session) if callable(self.limits) else self.limits
+        if (limits != None) and not (limits[0] <= value <= limits[1]):
+            raise CommandError("%s must be between %s and %s." %
+                               (self.name, limits[0], limits[1]))
+        return value
+
+class CommandSpec(object):
+    def __init__(self, verb, args, run, message=None):
+        (self.verb, self.args, self.run) = (verb, args, run)
+        self.message = message # Printed before running, as before.
+
+    def usage(self):
+        return " ".join([ self.verb ] + [ "<%s>" % arg.name for arg in self.args ])
+
+class CommandRegistry(object):
+    def __init__(self):
+        self.specs = collections.OrderedDict()
+        self.validations = collections.defaultdict(lambda: [0, 0.0]) # verb -> [count, seconds]
+
+    def register(self, spec):
+        self.specs[spec.verb] = spec
+        return spec
+
+    def validate(self, session, parsed):
+        # Returns (spec, values) for a parsed command, or raises CommandError.
+        start = time.time()
+        try:
+            if (parsed == []): raise CommandError("Empty command.")
+            spec = self.specs.get(parsed[0], None)
+            if (spec == None):
+                raise CommandError("Unknown command '%s'." % parsed[0])
+            if (len(parsed) - 1 != len(spec.args)):
+                raise CommandError("Usage: %s" % spec.usage())
+            values = [ spec.args[index].convert(session, parsed[index + 1])
+                       for index in xrange(len(spec.args)) ]
+            return (spec, values)
+        finally:
+            stats = self.validations[parsed[0] if parsed else ""]
+            stats[0] += 1
+            stats[1] += time.time() - start
+
+    def execute(self, session, parsed, validated=None):
+        # validated: validate()'s result, when the caller already has it.
+        if (validated == None): validated = self.validate(session, parsed)
+        (spec, values) = validated
+        if (spec.message != None): print spec.message
+        spec.run(session, parsed, values)
+
+    def stats(self):
+        return dict((verb, { "count": count, "micros": seconds / count * 1e6 })
+                    for (verb, (count, seconds)) in self.validations.items() if count)
+
+def splitCommands(line):
+    # "pan 175; tilt 160" -> [["pan", "175"], ["tilt", "160"]]
+    commands = []
+    for part in line.split(";"):
+        parsed = part.lower().split()
+        if parsed: commands.append(parsed)
+    return commands
+
+def tiltLimits(session):
+    return session.tiltLimits
+
+def adviceNumbers(session):
+    return [ str(number) for number in sorted(session.allAdvice) ]
+
+def defaultRegistry():
+    registry = CommandRegistry()
+    registry.register(CommandSpec("pan", [ Arg("position", "number") ],
+        lambda session, parsed, values: session.panOrTilt(parsed, "pan"),
+        "Rotating body"))
+    registry.register(CommandSpec("tilt", [ Arg("position", "number", limits=tiltLimits) ],
+        lambda session, parsed, values: session.panOrTilt(parsed, "tilt"),
+        "Tilting head"))
+    registry.register(CommandSpec("say", [ Arg("advice", "choice", choices=adviceNumbers) ],
+        lambda session, parsed, values: session.say(parsed)))
+    registry.register(CommandSpec("servo", [ Arg("motion", "choice", choices=["scan"]) ],
+        lambda session, parsed, values: session.runScan(),
+        "Calling both servos!!!"))
+    registry.register(CommandSpec("light", [ Arg("switch", "choice",
+                                                 choices=["on", "off", "test", "blink",
+                                                          "fade", "pulse"]) ],
+        lambda session, parsed, values: session.light(parsed),
+        "Controlling LEDs"))
+    registry.register(CommandSpec("stop", [],
+        lambda session, parsed, values: session.stopMotion()))
+    return registry
+
+def runBatch(session, stream=None, report=True):
+    # Validates and queues every command from stream, then waits for all.
+    from GullibotRuntime import SessionRuntime
+    if (stream == None): stream = sys.stdin
+    runtime = SessionRuntime(session, stream=stream, preempt=False)
+    for name in runtime.workers:
+        runtime.workers[name].thread.start()
+    start = time.time()
+    (accepted, rejected) = (0, 0)
+    for line in stream:
+        for parsed in splitCommands(line.split("#", 1)[0]):
+            if runtime.submitParsed(parsed, echo=False): accepted += 1
+            else: rejected += 1
+    queued = time.time() - start
+    runtime.stop()
+    runtime.wait()
+    elapsed = time.time() - start
+    result = { "commands": accepted, "rejected": rejected,
+               "queueSeconds": queued, "seconds": elapsed,
+               "commandsPerSecond": accepted / elapsed if elapsed else 0.0,
+               "validation": session.commands.stats() }
+    if report:
+        print "Batch: %d commands (%d rejected) in %.2f s, %.1f commands/s." % (
+            accepted, rejected, elapsed, result["commandsPerSecond"])
+        for verb in sorted(result["validation"]):
+            stats = result["validation"][verb]
+            print "  %-6s validated %4d times, %.1f us each." % (
+                verb, stats["count"], stats["micros"])
+    return result
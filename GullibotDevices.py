@@ -0,0 +1,200 @@
+"""
+Device output for Gullibot.
+
+Servoblaster takes lines of the form "channel=pulse\\n" on /dev/servoblaster.
+ServoblasterWriter keeps that device open for the whole session, remembers the
+last pulse value sent on every channel, and packs all channel updates made
+during one motion tick into a single write.
+
+GullibotSession takes three pluggable backends: PWM (a ServoblasterWriter),
+character display (anything with lcddriver.lcd's lcd_write) and audio
+(anything with play(soundFile)). The Recording* stand-ins log every write,
+timestamped, into a bounded EventLog so sessions can run without the robot.
+"""
+
+import time
+import threading
+import contextlib
+import collections
+
+from GullibotDisplay import MemoryCharDisplay, Rs
+
+class ServoblasterWriter(object):
+    def __init__(self, devicePath="/dev/servoblaster"):
+        # devicePath may also be a plain file or a FIFO, for testing off the robot.
+        self.devicePath = devicePath
+        self.device = None
+        self.lastSent = {}      # channel -> last pulse value written
+        self.pending = {}       # channel -> pulse value waiting for flush()
+        self.forced = set()     # channels to write even if unchanged
+        self.batchDepth = 0
+        self.lock = threading.RLock() # Motion and LED threads share a writer.
+        self.listener = None    # Optional callable(time) run after each write.
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.writesIssued = 0   # write() calls made on the device
+        self.writesSkipped = 0  # channel updates dropped (unchanged/coalesced)
+        self.updatesSent = 0    # channel lines actually sent
+
+    @staticmethod
+    def quantize(position):
+        # Servoblaster only takes integers; "%u" % 170.6 == "170".
+        return int(position)
+
+    def open(self):
+        if (self.device == None):
+            # Unbuffered, so that each flush() is exactly one write syscall.
+            self.device = open(self.devicePath, "wb", 0)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+        if (self.device != None):
+            self.device.close()
+            self.device = None
+
+    def write(self, channel, position, force=False):
+        # Queues a new pulse value. Sent right away unless inside tick().
+        with self.lock:
+            if (channel in self.pending): self.writesSkipped += 1 # Coalesced.
+            self.pending[channel] = self.quantize(position)
+            if force: self.forced.add(channel)
+            if (self.batchDepth == 0):
+                self.flush()
+
+    @contextlib.contextmanager
+    def tick(self):
+        # All writes inside the block go out together as one device write.
+        with self.lock:
+            self.batchDepth += 1
+            try:
+                yield self
+            finally:
+                self.batchDepth -= 1
+                if (self.batchDepth == 0):
+                    self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        lines = []
+        for channel in sorted(self.pending):
+            value = self.pending[channel]
+            if ((channel in self.forced) or (self.lastSent.get(channel) != value)):
+                lines.append("%u=%u\n" % (channel, value))
+                self.lastSent[channel] = value
+            else:
+                self.writesSkipped += 1
+        self.pending.clear()
+        self.forced.clear()
+        if lines:
+            self.open()
+            self.device.write(bytearray("".join(lines), 'UTF-8'))
+            self.writesIssued += 1
+            self.updatesSent += len(lines)
+            if (self.listener != None): self.listener(time.time())
+
+    def stats(self):
+        return { "writesIssued": self.writesIssued,
+                 "writesSkipped": self.writesSkipped,
+                 "updatesSent": self.updatesSent }
+
+class EventLog(object):
+    # Bounded, timestamped record of device writes. Oldest events drop first.
+    def __init__(self, maxEvents=100000, now=time.time):
+        self.events = collections.deque(maxlen=maxEvents)
+        self.now = now
+        self.total = 0
+
+    def record(self, device, kind, value):
+        self.events.append((self.now(), device, kind, value))
+        self.total += 1
+
+    def dropped(self):
+        return self.total - len(self.events)
+
+    def select(self, device=None, kind=None):
+        return [ event for event in self.events
+                 if ((device == None) or (event[1] == device)) and
+                    ((kind == None) or (event[2] == kind)) ]
+
+    def clear(self):
+        self.events.clear()
+        self.total = 0
+
+class RecordingSink(object):
+    # File-like stand-in for /dev/servoblaster; logs each "ch=value" line.
+    def __init__(self, log):
+        self.log = log
+        self.closed = False
+
+    def write(self, data):
+        for line in str(data).splitlines():
+            (channel, value) = line.split("=")
+            self.log.record("pwm", int(channel), int(value))
+
+    def close(self):
+        self.closed = True
+
+class RecordingPWM(ServoblasterWriter):
+    # ServoblasterWriter (same coalescing) that writes into an EventLog.
+    def __init__(self, log):
+        ServoblasterWriter.__init__(self, devicePath=None)
+        self.log = log
+
+    def open(self):
+        if (self.device == None):
+            self.device = RecordingSink(self.log)
+
+class RecordingDisplay(MemoryCharDisplay):
+    # In-memory LCD that also logs every byte: "char" or "cmd".
+    def __init__(self, log, numLines=4, lineLength=20):
+        MemoryCharDisplay.__init__(self, numLines, lineLength)
+        self.log = log
+
+    def lcd_write(self, cmd, mode=0):
+        MemoryCharDisplay.lcd_write(self, cmd, mode)
+        self.log.record("lcd", "char" if (mode & Rs) else "cmd", cmd)
+
+def openCharDisplay():
+    # The real display (HD44780 on the I2C backpack; see GullibotLCD).
+    from GullibotLCD import openDisplay
+    return openDisplay()
+
+class LazyCharDisplay(object):
+    # Opens the real display on a background thread (the driver's power-on
+    # pauses overlap the rest of startup); the first write waits for it.
+    def __init__(self, opener=openCharDisplay):
+        self.opener = opener
+        self.lcd = None
+        self.error = None
+        self.openSeconds = None
+        self.thread = threading.Thread(target=self.open, name="lcd-open")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self):
+        start = time.time()
+        try:
+            self.lcd = self.opener()
+        except Exception as error:
+            self.error = error
+        self.openSeconds = time.time() - start
+
+    def ready(self):
+        self.thread.join()
+        if (self.error != None): raise self.error
+        return self.lcd
+
+    def lcd_write(self, cmd, mode=0):
+        self.ready().lcd_write(cmd, mode)
+
+    def __getattr__(self, name):
+        return getattr(self.ready(), name)
+
+class RecordingAudio(object):
+    def __init__(self, log):
+        self.log = log
+
+    def play(self, soundFile):
+        self.log.record("audio", "play", soundFile)
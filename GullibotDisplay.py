@@ -0,0 +1,145 @@
+"""
+Character display output for Gullibot.
+
+CharFramebuffer keeps a shadow copy of what is on the 4 x 20 LCD and, for
+each new frame, sends only the character runs that changed, moving the
+cursor with "set DDRAM address" commands in between. It talks to anything
+with lcddriver.lcd's lcd_write(cmd, mode) method, and sends each frame as
+one batch when the display has batch() (GullibotLCD.HD44780); MemoryCharDisplay
+is an in-memory stand-in for testing without the display.
+"""
+
+import contextlib
+
+LCD_SETDDRAMADDR = 0x80
+Rs = 0x01 # Register select: data (character) rather than command.
+# DDRAM address of the first character of each row (HD44780, 4 x 20).
+ROW_ADDRESSES = [ 0x00, 0x40, 0x14, 0x54 ]
+# lcddriver sends each byte as two nibbles, each one write plus an enable
+# strobe (high, low) on the I2C expander. Only used to estimate transactions
+# for displays that do not count them (GullibotLCD.HD44780 does).
+TRANSACTIONS_PER_BYTE = 6
+
+class CharFramebuffer(object):
+    def __init__(self, lcd, numLines=4, lineLength=20):
+        self.lcd = lcd
+        (self.numLines, self.lineLength) = (numLines, lineLength)
+        self.cursor = None # DDRAM address the LCD will write to next.
+        self.glass = [ " " * lineLength for line in xrange(numLines) ]
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.updates = 0
+        self.bytesSent = 0
+        self.lastBytes = 0
+        self.transactions = 0
+        self.lastTransactions = 0
+
+    def invalidate(self):
+        # Forces the next frame to be sent in full (e.g. after lcd_clear).
+        self.glass = [ None ] * self.numLines
+        self.cursor = None
+
+    def normalize(self, lines):
+        frame = []
+        for index in xrange(self.numLines):
+            line = lines[index] if (index < len(lines)) else ""
+            frame.append(line[:self.lineLength].ljust(self.lineLength))
+        return frame
+
+    def changedRuns(self, old, new):
+        # Yields (start, text) for runs that differ. Gaps of one unchanged
+        # character are rewritten rather than paying for a cursor move.
+        if (old == None):
+            yield (0, new)
+            return
+        (start, end) = (None, None)
+        for column in xrange(len(new)):
+            if (old[column] != new[column]):
+                if (start == None):
+                    start = column
+                elif (column - end > 2):
+                    yield (start, new[start:end + 1])
+                    start = column
+                end = column
+        if (start != None):
+            yield (start, new[start:end + 1])
+
+    @contextlib.contextmanager
+    def transfer(self):
+        # One batch per frame, when the display has batch() (GullibotLCD).
+        batch = getattr(self.lcd, "batch", None)
+        if (batch == None):
+            yield
+        else:
+            with batch(): yield
+
+    def show(self, lines):
+        # Sends the difference between lines and the glass. Returns bytes sent.
+        frame = self.normalize(lines)
+        counted = getattr(self.lcd, "transactions", None)
+        with self.transfer():
+            self.showFrame(frame)
+        if (counted != None):
+            self.lastTransactions = self.lcd.transactions - counted
+        else: # lcddriver: estimated from the bytes sent.
+            self.lastTransactions = self.lastBytes * TRANSACTIONS_PER_BYTE
+        self.transactions += self.lastTransactions
+        return self.lastBytes
+
+    def showFrame(self, frame):
+        sent = 0
+        for row in xrange(self.numLines):
+            for (column, text) in self.changedRuns(self.glass[row], frame[row]):
+                address = ROW_ADDRESSES[row] + column
+                if (address != self.cursor):
+                    self.lcd.lcd_write(LCD_SETDDRAMADDR | address)
+                    sent += 1
+                for char in text:
+                    self.lcd.lcd_write(ord(char), Rs)
+                sent += len(text)
+                self.cursor = address + len(text)
+            self.glass[row] = frame[row]
+        self.updates += 1
+        self.bytesSent += sent
+        self.lastBytes = sent
+
+    def stats(self):
+        return { "updates": self.updates,
+                 "bytesSent": self.bytesSent,
+                 "transactions": self.transactions,
+                 "lastBytes": self.lastBytes,
+                 "lastTransactions": self.lastTransactions }
+
+class MemoryCharDisplay(object):
+    # Stand-in for lcddriver.lcd: models DDRAM and the cursor, counts bytes.
+    def __init__(self, numLines=4, lineLength=20):
+        (self.numLines, self.lineLength) = (numLines, lineLength)
+        self.ddram = [ " " ] * 0x80
+        self.cursor = 0
+        self.bytesWritten = 0
+
+    def lcd_write(self, cmd, mode=0):
+        self.bytesWritten += 1
+        if (mode & Rs):
+            self.ddram[self.cursor] = chr(cmd)
+            self.cursor = (self.cursor + 1) & 0x7F
+        elif (cmd & LCD_SETDDRAMADDR):
+            self.cursor = cmd & 0x7F
+
+    def lcd_display_string(self, string, line):
+        self.lcd_write(LCD_SETDDRAMADDR | ROW_ADDRESSES[line - 1])
+        for char in string:
+            self.lcd_write(ord(char), Rs)
+
+    def lcd_clear(self):
+        self.bytesWritten += 1
+        self.ddram = [ " " ] * 0x80
+        self.cursor = 0
+
+    def rows(self):
+        # What a person would read on the glass.
+        lines = []
+        for address in ROW_ADDRESSES[:self.numLines]:
+            lines.append("".join(self.ddram[address:address + self.lineLength]))
+        return lines
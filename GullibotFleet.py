@@ -0,0 +1,200 @@
+"""
+Fleet controller for several Gullibots.
+
+Each robot runs GullibotServer. FleetController keeps a small pool of
+persistent connections per robot, and one command queue per robot served
+by the pool's worker threads. With a pool of one (the default), commands
+to a robot run in the order sent. Commands can target one robot or be
+broadcast; every command returns a PendingReply, and round-trip latencies
+are collected for fleet-wide stats.
+
+    python GullibotFleet.py --sizes 1,2,4,8,16,32
+spawns that many stand-in robot processes on this machine and reports how
+command throughput scales.
+"""
+
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import collections
+import Queue
+
+class PendingReply(object):
+    def __init__(self, robot, cmd):
+        (self.robot, self.cmd) = (robot, cmd)
+        self.sent = time.time()
+        self.done = threading.Event()
+        self.reply = None
+
+    def finish(self, reply):
+        self.reply = reply
+        self.latency = time.time() - self.sent
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.reply
+
+class RobotConnection(object):
+    # One persistent connection speaking GullibotServer's line protocol.
+    def __init__(self, address, timeout=30.0):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+        self.nextId = 0
+
+    def request(self, cmd):
+        self.nextId += 1
+        self.sock.sendall(json.dumps({ "id": self.nextId, "cmd": cmd }) + "\n")
+        line = self.rfile.readline()
+        if not line: raise IOError("Robot closed the connection.")
+        return json.loads(line)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+class RobotLink(object):
+    # A robot's command queue and the workers (one per pooled connection).
+    def __init__(self, name, address, fleet, poolSize=1):
+        (self.name, self.address, self.fleet) = (name, address, fleet)
+        self.queue = Queue.Queue()
+        self.workers = []
+        for index in xrange(poolSize):
+            worker = threading.Thread(target=self.work,
+                                      name="%s-%d" % (name, index))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        connection = None
+        while True:
+            pending = self.queue.get()
+            if (pending == None): break
+            try:
+                if (connection == None):
+                    connection = RobotConnection(self.address)
+                reply = connection.request(pending.cmd)
+            except (IOError, socket.error, ValueError) as error:
+                if (connection != None): connection.close()
+                connection = None # Reconnect on the next command.
+                reply = { "ok": False, "error": str(error) }
+            pending.finish(reply)
+            self.fleet.record(pending) # Before waiters wake up.
+            pending.done.set()
+        if (connection != None): connection.close()
+
+    def close(self):
+        for worker in self.workers: self.queue.put(None)
+        for worker in self.workers: worker.join()
+
+class FleetController(object):
+    def __init__(self, addresses, poolSize=1, historySize=100000):
+        # addresses: dict of robot name -> (host, port).
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=historySize)
+        self.failures = 0
+        self.robots = collections.OrderedDict()
+        for name in sorted(addresses):
+            self.robots[name] = RobotLink(name, addresses[name], self, poolSize)
+
+    def send(self, robot, cmd):
+        pending = PendingReply(robot, cmd)
+        self.robots[robot].queue.put(pending)
+        return pending
+
+    def broadcast(self, cmd):
+        return [ self.send(robot, cmd) for robot in self.robots ]
+
+    def record(self, pending):
+        with self.lock:
+            self.latencies.append(pending.latency)
+            if not pending.reply.get("ok", False): self.failures += 1
+
+    def resetStats(self):
+        with self.lock:
+            self.latencies.clear()
+            self.failures = 0
+
+    def stats(self):
+        with self.lock:
+            samples = sorted(self.latencies)
+            failures = self.failures
+        def percentile(p):
+            if not samples: return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+        return { "commands": len(samples), "failures": failures,
+                 "latencyP50": percentile(0.50), "latencyP99": percentile(0.99),
+                 "latencyMax": samples[-1] if samples else 0.0 }
+
+    def close(self):
+        for robot in self.robots.values(): robot.close()
+
+def spawnStandIns(count):
+    # Starts count stand-in robot processes; returns (processes, addresses).
+    processes = []
+    addresses = {}
+    for index in xrange(count):
+        process = subprocess.Popen([sys.executable, "GullibotServer.py",
+                                    "--standin", "--quiet", "--port", "0"],
+                                   stdout=subprocess.PIPE)
+        processes.append(process)
+    for index in xrange(count):
+        line = processes[index].stdout.readline()  # "Listening on host:port"
+        (host, port) = line.split()[-1].rsplit(":", 1)
+        addresses["robot%02d" % index] = (host, int(port))
+    return (processes, addresses)
+
+def benchScaling(sizes, commandsPerRobot=50, poolSize=1):
+    # Broadcasts a mix of quick commands and reports throughput per fleet size.
+    workload = [ "light on", "say 1", "light off", "status" ]
+    results = []
+    for size in sizes:
+        (processes, addresses) = spawnStandIns(size)
+        fleet = FleetController(addresses, poolSize)
+        try:
+            for pending in fleet.broadcast("status"): pending.wait() # Warm up.
+            fleet.resetStats()
+            start = time.time()
+            replies = []
+            for index in xrange(commandsPerRobot):
+                replies += fleet.broadcast(workload[index % len(workload)])
+            for pending in replies: pending.wait()
+            elapsed = time.time() - start
+            stats = fleet.stats()
+            stats.update({ "robots": size, "seconds": elapsed,
+                           "commandsPerSecond": stats["commands"] / elapsed })
+            results.append(stats)
+        finally:
+            fleet.close()
+            for process in processes: process.terminate()
+            for process in processes: process.wait()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gullibot fleet scaling benchmark.")
+    parser.add_argument("--sizes", default="1,2,4,8,16,32")
+    parser.add_argument("--commands", type=int, default=50,
+                        help="commands per robot")
+    parser.add_argument("--pool", type=int, default=1,
+                        help="connections per robot")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args(argv)
+    sizes = [ int(size) for size in args.sizes.split(",") ]
+    results = benchScaling(sizes, args.commands, args.pool)
+    print "%6s %9s %10s %9s %9s %6s" % ("robots", "commands", "cmds/s",
+                                       "p50 ms", "p99 ms", "fails")
+    for row in results:
+        print "%6d %9d %10.1f %9.2f %9.2f %6d" % (
+            row["robots"], row["commands"], row["commandsPerSecond"],
+            row["latencyP50"] * 1000, row["latencyP99"] * 1000, row["failures"])
+    if args.output:
+        with open(args.output, "w") as data:
+            json.dump(results, data, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Cancellable motion jobs for Gullibot.
+
+Every gesture or move runs as a MotionJob. The motion loop checks its job
+once per tick, so cancel() (from "stop", or from a new motion command in
+the console) takes effect on the next tick: the session then eases each
+moving axis to a hold at its acceleration limit, and raises MotionCancelled
+to unwind the rest of the gesture. executeCmd reports it as "Stopped."
+
+MotionJobs keeps the current job and the measured cancellation latencies
+(from cancel() to the first easing write), in ticks.
+"""
+
+import time
+import threading
+import contextlib
+import collections
+
+class MotionCancelled(Exception):
+    pass
+
+class MotionJob(object):
+    def __init__(self, name, now=time.time):
+        (self.name, self.now) = (name, now)
+        self.cancelled = threading.Event()
+        self.cancelStamp = None
+
+    def cancel(self, stamp=None):
+        if not self.cancelled.is_set():
+            self.cancelStamp = stamp if (stamp != None) else self.now()
+            self.cancelled.set()
+
+class MotionJobs(object):
+    def __init__(self, period, historySize=500, now=time.time):
+        (self.period, self.now) = (period, now)
+        self.current = None
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=historySize) # seconds
+
+    @contextlib.contextmanager
+    def job(self, name):
+        # Starts a job, or joins the one already running (a move within a
+        # gesture belongs to the gesture).
+        with self.lock:
+            outer = (self.current == None)
+            if outer: self.current = MotionJob(name, self.now)
+            job = self.current
+        try:
+            yield job
+        finally:
+            if outer:
+                with self.lock: self.current = None
+
+    def cancel(self, stamp=None):
+        # Cancels the running job, if any. Returns it.
+        with self.lock:
+            job = self.current
+        if (job != None): job.cancel(stamp)
+        return job
+
+    def cancelled(self):
+        job = self.current
+        return (job != None) and job.cancelled.is_set()
+
+    def stopped(self, when=None):
+        # Called at the first write after a cancel; records the latency.
+        job = self.current
+        if (job != None) and (job.cancelStamp != None):
+            if (when == None): when = self.now()
+            self.latencies.append(max(0.0, when - job.cancelStamp))
+            job.cancelStamp = None # Count each cancel once.
+
+    def stats(self):
+        samples = sorted(self.latencies)
+        if not samples: return { "cancels": 0 }
+        def ticks(seconds): return seconds / self.period
+        return { "cancels": len(samples),
+                 "latencyP50Ticks": ticks(samples[len(samples) // 2]),
+                 "latencyP99Ticks": ticks(samples[min(len(samples) - 1,
+                                                      int(0.99 * len(samples)))]),
+                 "latencyMaxTicks": ticks(samples[-1]),
+                 "withinTwoTicks": sum(1 for s in samples if ticks(s) <= 2.0) /
+                                   float(len(samples)) }
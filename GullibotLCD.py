@@ -0,0 +1,211 @@
+"""
+Character display driver for Gullibot: an HD44780 4 x 20 LCD behind a
+PCF8574 I2C backpack (address 0x27 on bus 1), in place of lcddriver and
+i2c_lib.
+
+The PCF8574 copies each byte it receives onto its eight output pins, which
+drive the LCD's D4-D7, backlight, E, RW and RS lines. Every LCD byte goes
+over as two nibbles, and each nibble as three pin states: data, data with
+E high, data again (the LCD latches on E falling). lcddriver sends each pin
+state as its own SMBus write with a sleep after it, about 1.8 ms per LCD
+byte. HD44780 encodes the whole sequence into one buffer instead and sends
+it as a single I2C write: at 100-400 kHz every pin state already lasts
+longer than the 37 us the LCD needs per byte, so only clear/home and the
+power-on sequence need an explicit pause. Writes inside batch() (see
+CharFramebuffer.show) go out together when the batch ends; os.write on
+/dev/i2c-N releases the GIL, so other threads run during the transfer.
+
+I2CBus is the real bus. StandInBus counts transactions and models bus time
+and pauses, and decodes the pin states back into a MemoryCharDisplay, so
+both write paths can be checked and benchmarked without the robot:
+
+    HD44780(StandInBus(), blockWrites=False)  # lcddriver's per-byte path
+    HD44780(StandInBus())                     # block writes
+"""
+
+import os
+import time
+import fcntl
+import threading
+import contextlib
+
+from GullibotDisplay import MemoryCharDisplay, LCD_SETDDRAMADDR, Rs, ROW_ADDRESSES
+
+# PCF8574 pins (as wired on the common backpacks).
+En = 0x04
+Rw = 0x02
+BACKLIGHT = 0x08
+
+LCD_CLEARDISPLAY = 0x01
+LCD_RETURNHOME = 0x02
+LCD_ENTRYMODE_LEFT = 0x06
+LCD_DISPLAY_ON = 0x0C
+LCD_FUNCTION_4BIT_2LINE = 0x28
+
+I2C_SLAVE = 0x0703 # ioctl: set the address for later read()/write().
+LEGACY_PAUSES = (0.0001, 0.0006, 0.0002) # lcddriver's sleeps after each pin state.
+CLEAR_SECONDS = 0.002 # Clear and home take 1.52 ms.
+
+class I2CBus(object):
+    # Raw writes to /dev/i2c-N; each write() is one I2C transaction.
+    def __init__(self, port=1, address=0x27):
+        self.fd = os.open("/dev/i2c-%d" % port, os.O_RDWR)
+        fcntl.ioctl(self.fd, I2C_SLAVE, address)
+
+    def write(self, data):
+        os.write(self.fd, str(data))
+
+    def delay(self, seconds):
+        time.sleep(seconds)
+
+    def close(self):
+        if (self.fd != None): os.close(self.fd)
+        self.fd = None
+
+class StandInBus(object):
+    # Models the bus instead of driving it. Each transaction costs a start
+    # bit, the address and data bytes (9 clocks each) and a stop bit, plus
+    # perTransaction seconds of software overhead (syscall, Python).
+    def __init__(self, clockHz=100000, perTransaction=0.0, numLines=4,
+                 lineLength=20):
+        (self.clockHz, self.perTransaction) = (clockHz, perTransaction)
+        self.display = MemoryCharDisplay(numLines, lineLength)
+        self.port = 0
+        self.fourBit = False
+        self.highNibble = None
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.transactions = 0
+        self.bytesSent = 0
+        self.busSeconds = 0.0
+        self.delaySeconds = 0.0
+
+    def write(self, data):
+        self.transactions += 1
+        self.bytesSent += len(data)
+        self.busSeconds += (2 + 9 * (len(data) + 1)) / float(self.clockHz)
+        self.busSeconds += self.perTransaction
+        for value in bytearray(data):
+            if (self.port & En) and not (value & En): self.latch(self.port)
+            self.port = value
+
+    def delay(self, seconds):
+        self.delaySeconds += seconds
+
+    def modeledSeconds(self):
+        return self.busSeconds + self.delaySeconds
+
+    def latch(self, value):
+        # The LCD reads D4-D7 and RS on E falling.
+        nibble = value & 0xF0
+        if not self.fourBit: # After power-on: 8-bit instructions, D0-D3 low.
+            if (nibble == 0x20): self.fourBit = True
+            return
+        if (self.highNibble == None):
+            self.highNibble = nibble
+            return
+        (byte, self.highNibble) = (self.highNibble | (nibble >> 4), None)
+        if (value & Rs):
+            self.display.lcd_write(byte, Rs)
+        elif (byte == LCD_CLEARDISPLAY):
+            self.display.lcd_clear()
+        elif (byte & LCD_SETDDRAMADDR):
+            self.display.lcd_write(byte)
+        elif ((byte & 0xFE) == LCD_RETURNHOME):
+            self.display.cursor = 0
+
+    def rows(self):
+        return self.display.rows()
+
+    def close(self):
+        pass
+
+class HD44780(object):
+    # Has lcddriver.lcd's methods, so CharFramebuffer and LazyCharDisplay
+    # take it as is, plus batch().
+    def __init__(self, bus, blockWrites=True, maxTransfer=4096, backlight=True):
+        # maxTransfer: bytes per I2C write (i2c-dev allows up to 8192).
+        (self.bus, self.blockWrites, self.maxTransfer) = (bus, blockWrites, maxTransfer)
+        self.backlight = BACKLIGHT if backlight else 0
+        self.pending = bytearray()
+        self.depth = 0
+        self.lock = threading.RLock()
+        self.bytesWritten = 0
+        self.transactions = 0 # Bus writes; CharFramebuffer.stats reports them.
+        self.initialize()
+
+    def initialize(self):
+        # HD44780 initialization by instruction: three 8-bit function sets,
+        # then switch to 4 bits, with the datasheet's pauses in between.
+        with self.batch():
+            self.pause(0.05)
+            for (nibble, seconds) in [ (0x30, 0.0045), (0x30, 0.00015),
+                                       (0x30, 0.00015), (0x20, 0.00015) ]:
+                self.writeNibble(nibble)
+                self.pause(seconds)
+            for cmd in [ LCD_FUNCTION_4BIT_2LINE, LCD_DISPLAY_ON,
+                         LCD_CLEARDISPLAY, LCD_ENTRYMODE_LEFT ]:
+                self.lcd_write(cmd)
+
+    def writeNibble(self, bits):
+        # bits: D4-D7 in the high nibble, plus RS.
+        value = bits | self.backlight
+        states = (value, value | En, value)
+        if self.blockWrites:
+            self.pending.extend(states)
+            if (self.depth == 0): self.flush()
+        else: # lcddriver: one write per pin state, each followed by a sleep.
+            for (state, seconds) in zip(states, LEGACY_PAUSES):
+                self.bus.write(bytearray([ state ]))
+                self.transactions += 1
+                self.bus.delay(seconds)
+
+    def pause(self, seconds):
+        self.flush()
+        self.bus.delay(seconds)
+
+    def flush(self):
+        with self.lock:
+            while self.pending:
+                self.bus.write(self.pending[:self.maxTransfer])
+                self.transactions += 1
+                del self.pending[:self.maxTransfer]
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Everything written inside goes out when the outermost batch ends.
+        with self.lock:
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+                if (self.depth == 0): self.flush()
+
+    def lcd_write(self, cmd, mode=0):
+        with self.lock:
+            self.writeNibble(mode | (cmd & 0xF0))
+            self.writeNibble(mode | ((cmd << 4) & 0xF0))
+            self.bytesWritten += 1
+            if self.blockWrites and (mode == 0) and \
+               (cmd in [ LCD_CLEARDISPLAY, LCD_RETURNHOME ]):
+                self.pause(CLEAR_SECONDS)
+
+    def lcd_display_string(self, string, line):
+        with self.batch():
+            self.lcd_write(LCD_SETDDRAMADDR | ROW_ADDRESSES[line - 1])
+            for char in string:
+                self.lcd_write(ord(char), Rs)
+
+    def lcd_clear(self):
+        with self.batch():
+            self.lcd_write(LCD_CLEARDISPLAY)
+            self.lcd_write(LCD_RETURNHOME)
+
+    def close(self):
+        self.flush()
+        self.bus.close()
+
+def openDisplay(port=1, address=0x27):
+    return HD44780(I2CBus(port, address))
@@ -0,0 +1,153 @@
+"""
+LED patterns for Gullibot.
+
+A pattern is a list of (level, seconds) steps played on one LED, for a number
+of repeats or forever. LedEngine keeps every running pattern's next step on
+a hashed timer wheel (one slot per tick, wrapping), so starting or stopping
+a pattern is a dict insert or delete, and each tick only touches the
+patterns due then.
+
+advance() plays everything due up to now. It is called from the motion loop
+inside the servo writer's tick(), so LED and servo changes of the same tick
+go out in one device write, and from a background thread so patterns keep
+running while nothing is moving. Under a SimulatedClock there is no
+thread; the clock calls follow() as virtual time passes instead.
+"""
+
+import time
+import threading
+
+def blink(on=220, off=0, period=0.2):
+    return [ (on, period / 2.0), (off, period / 2.0) ]
+
+def pulse(level=220, width=0.05, period=1.0, off=0):
+    return [ (level, width), (off, period - width) ]
+
+def fade(low=100, high=220, period=1.0, steps=10):
+    # Ramps up then back down through `steps` PWM levels each way.
+    levels = [ low + (high - low) * index / float(steps)
+               for index in xrange(steps + 1) ]
+    levels = levels + levels[-2:0:-1]
+    return [ (int(round(level)), period / len(levels)) for level in levels ]
+
+class LedPattern(object):
+    def __init__(self, name, steps, repeat=None, finalLevel=0):
+        self.name = name          # LED name, e.g. "scan"
+        self.steps = steps        # [(level, ticks)]
+        self.repeat = repeat      # None = forever
+        self.finalLevel = finalLevel
+        self.stepIndex = 0
+        self.dueTick = None
+
+class LedEngine(object):
+    def __init__(self, output, writer, period=0.01, wheelSize=512, now=time.time,
+                 sleep=time.sleep):
+        # output(name, level) sets an LED; writer is the ServoblasterWriter,
+        # whose tick() groups this engine's writes with servo writes.
+        (self.output, self.writer) = (output, writer)
+        (self.period, self.now, self.sleep) = (period, now, sleep)
+        self.wheel = [ {} for slot in xrange(wheelSize) ] # name -> pattern
+        self.patterns = {} # name -> running pattern
+        self.origin = now()
+        self.currentTick = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def tickAt(self, when):
+        return int((when - self.origin) / self.period)
+
+    def schedule(self, pattern, tick):
+        pattern.dueTick = tick
+        self.wheel[tick % len(self.wheel)][pattern.name] = pattern
+
+    def start(self, name, steps, repeat=None, finalLevel=0):
+        # Replaces any pattern on this LED. steps: [(level, seconds)].
+        ticks = [ (level, max(1, int(round(seconds / self.period))))
+                  for (level, seconds) in steps ]
+        pattern = LedPattern(name, ticks, repeat, finalLevel)
+        with self.writer.tick(): # Also serializes with advance().
+            self.stop(name, level=None)
+            now = self.tickAt(self.now())
+            if not self.patterns: self.currentTick = max(self.currentTick, now - 1)
+            self.patterns[name] = pattern
+            self.schedule(pattern, max(self.currentTick + 1, now))
+        self.wakeup.set()
+        return pattern
+
+    def stop(self, name, level=0):
+        # Stops the pattern on this LED and sets it to level (None = leave).
+        with self.writer.tick():
+            pattern = self.patterns.pop(name, None)
+            if (pattern != None):
+                self.wheel[pattern.dueTick % len(self.wheel)].pop(name, None)
+            if (level != None):
+                self.output(name, level)
+
+    def isRunning(self, name):
+        return (name in self.patterns)
+
+    def fire(self, pattern, tick):
+        if (pattern.stepIndex == len(pattern.steps)):
+            pattern.stepIndex = 0
+            if (pattern.repeat != None):
+                pattern.repeat -= 1
+                if (pattern.repeat <= 0):
+                    del self.patterns[pattern.name]
+                    self.output(pattern.name, pattern.finalLevel)
+                    return
+        (level, ticks) = pattern.steps[pattern.stepIndex]
+        pattern.stepIndex += 1
+        self.output(pattern.name, level)
+        self.schedule(pattern, tick + ticks)
+
+    def advance(self, when=None):
+        # Plays every step due up to `when` (default now).
+        target = self.tickAt(self.now() if (when == None) else when)
+        with self.writer.tick():
+            while (self.currentTick < target) and self.patterns:
+                self.currentTick += 1
+                slot = self.wheel[self.currentTick % len(self.wheel)]
+                if not slot: continue
+                for pattern in [ p for p in slot.values()
+                                 if (p.dueTick == self.currentTick) ]:
+                    del slot[pattern.name]
+                    self.fire(pattern, self.currentTick)
+            if not self.patterns: self.currentTick = max(self.currentTick, target)
+
+    def follow(self, when):
+        # SimulatedClock listener. An idle engine has nothing due, and
+        # start() catches its tick up, so only running patterns advance.
+        if self.patterns: self.advance(when)
+
+    def wait(self, timeout=None):
+        # Blocks until every finite pattern is done (or timeout seconds).
+        deadline = None if (timeout == None) else (self.now() + timeout)
+        while self.patterns:
+            if (deadline != None) and (self.now() > deadline): return False
+            self.sleep(self.period)
+        return True
+
+    def startBackground(self):
+        # Keeps patterns going when no motion loop is calling advance().
+        if (self.thread != None): return
+        self.running = True
+        self.thread = threading.Thread(target=self.work, name="leds")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        while self.running:
+            if not self.patterns:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            self.advance()
+            self.sleep(self.period)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        if (self.thread != None):
+            self.thread.join()
+            self.thread = None
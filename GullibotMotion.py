@@ -0,0 +1,178 @@
+"""
+Multi-axis motion planning for Gullibot.
+
+planProfile turns a set of per-axis targets into a list of frames, one per
+motion clock tick. Each frame is a dict of axis -> setpoint, and all axes
+are interpolated together, so pan, tilt and LED levels can move at once.
+
+Axes listed in ramped can follow a trapezoidal velocity profile instead:
+accelerate at the axis's limit up to its peak speed (units per tick),
+cruise, slow down again, instead of starting and stopping at full speed.
+At the same peak that costs speed / accel ticks more than a constant
+step, so it is opt-in per axis (GullibotSession.rampedAxes, empty by
+default) until the peak speeds are raised and checked on the robot. Even
+on a ramped axis, moves shorter than 2 * speed**2 / accel (twice what the
+two ramps cover) keep the constant step: ramps would make them half as
+long again or more. Each axis's samples are computed as a whole array
+(with numpy when it is installed) and memoized in a bounded LRU cache, so
+repeated gestures such as nod and scan replay precomputed samples.
+"""
+
+import math
+import threading
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def usesTrapezoid(distance, speed, accel):
+    # Whether the move is longer than 2 * speed**2 / accel, twice the
+    # distance the two ramps cover; below that, ramps add 50% or more.
+    if (accel == None) or (accel <= 0): return False
+    return abs(distance) > 2 * speed * speed / float(accel)
+
+def linearSamples(start, target, numFrames):
+    samples = [ start + (target - start) * float(index) / numFrames
+                for index in xrange(1, numFrames + 1) ]
+    samples[-1] = target
+    return samples
+
+def trapezoidTicks(distance, speed, accel):
+    # Duration in ticks of a rest-to-rest move: (total, accelerating, peak speed).
+    distance = abs(distance)
+    if (accel == None) or (accel <= 0):
+        return (distance / float(speed), 0.0, float(speed))
+    accelTicks = speed / float(accel)
+    if (distance <= speed * accelTicks): # Never reaches full speed.
+        accelTicks = math.sqrt(distance / float(accel))
+        return (2 * accelTicks, accelTicks, accel * accelTicks)
+    return (accelTicks + distance / float(speed), accelTicks, float(speed))
+
+def trapezoidSamples(start, target, speed, accel, numFrames):
+    # Setpoints at ticks 1..numFrames of a trapezoid stretched over numFrames.
+    distance = target - start
+    (total, accelTicks, peak) = trapezoidTicks(distance, speed, accel)
+    sign = +1 if (distance >= 0) else -1
+    half = 0.5 * peak * accelTicks # Distance covered while accelerating.
+    scale = total / numFrames
+    if (numpy != None):
+        t = numpy.arange(1, numFrames + 1) * scale
+        if (accelTicks > 0):
+            rate = peak / accelTicks
+            covered = numpy.where(t < accelTicks, 0.5 * rate * t * t,
+                      numpy.where(t > total - accelTicks,
+                                  abs(distance) - 0.5 * rate * (total - t) ** 2,
+                                  half + peak * (t - accelTicks)))
+        else:
+            covered = peak * t
+        samples = (start + sign * numpy.minimum(covered, abs(distance))).tolist()
+    else:
+        rate = (peak / accelTicks) if (accelTicks > 0) else 0.0
+        samples = []
+        for index in xrange(1, numFrames + 1):
+            t = index * scale
+            if (t < accelTicks):
+                covered = 0.5 * rate * t * t
+            elif (t > total - accelTicks):
+                covered = abs(distance) - 0.5 * rate * (total - t) ** 2
+            else:
+                covered = half + peak * (t - accelTicks)
+            samples.append(start + sign * min(covered, abs(distance)))
+    samples[-1] = target
+    return samples
+
+class ProfileCache(object):
+    # Bounded LRU of sample lists keyed by
+    # (axis, start, target, speed, accel, numFrames).
+    # Shared by the session and the timeline's prefetch thread.
+    def __init__(self, maxSize=512):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        (self.hits, self.misses) = (0, 0)
+
+    def samples(self, axis, start, target, speed, accel, numFrames):
+        key = (axis, start, target, speed, accel, numFrames)
+        with self.lock:
+            samples = self.entries.pop(key, None)
+            if (samples != None):
+                self.hits += 1
+                self.entries[key] = samples # Most recently used.
+                return samples
+            self.misses += 1
+        samples = trapezoidSamples(start, target, speed, accel, numFrames)
+        with self.lock:
+            self.entries.pop(key, None) # Another thread may have added it.
+            if (len(self.entries) >= self.maxSize):
+                self.entries.popitem(last=False) # Least recently used.
+            self.entries[key] = samples
+        return samples
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            (self.hits, self.misses) = (0, 0)
+
+profileCache = ProfileCache()
+
+def stepsFor(distance, rate):
+    # Ticks needed to cover distance at a constant rate per tick (at least 1).
+    if (rate == None) or (rate <= 0): return 1
+    return max(1, int(math.ceil(abs(distance) / float(rate) - 1e-9)))
+
+def profileFrames(distance, speed, accel):
+    # Ticks needed for a move: trapezoidal when long enough, else constant.
+    if (speed == None) or (speed <= 0): return 1
+    if not usesTrapezoid(distance, speed, accel): return stepsFor(distance, speed)
+    return max(1, int(math.ceil(trapezoidTicks(distance, speed, accel)[0] - 1e-9)))
+
+def planProfile(starts, targets, speeds, accels, sync=True, ramped=(),
+                cache=profileCache):
+    # starts/targets/speeds/accels: dicts keyed by axis; speeds are peak
+    # units per tick, accels units per tick per tick. Only axes in ramped
+    # use the trapezoid; the others move at a constant step. Axes missing from
+    # speeds move linearly with the others (sync) or jump straight to
+    # target. sync=True stretches every axis's profile to finish with the
+    # slowest one, otherwise each moves at its own rate and then holds.
+    # The last frame always holds the exact targets.
+    axes = [ axis for axis in targets if (starts.get(axis) != None) ]
+    if not axes: return []
+    accels = dict((axis, accels.get(axis)) for axis in axes if (axis in ramped))
+    steps = {}
+    for axis in axes:
+        steps[axis] = profileFrames(targets[axis] - starts[axis],
+                                    speeds.get(axis), accels.get(axis))
+    numFrames = max(steps.values())
+    columns = {}
+    for axis in axes:
+        (start, target) = (starts[axis], targets[axis])
+        if (speeds.get(axis) == None) or (speeds[axis] <= 0) or (start == target):
+            if sync:
+                columns[axis] = linearSamples(start, target, numFrames)
+            else:
+                columns[axis] = [ target ] * numFrames
+            continue
+        count = numFrames if sync else steps[axis]
+        if usesTrapezoid(target - start, speeds[axis], accels.get(axis)):
+            column = cache.samples(axis, start, target, speeds[axis],
+                                   accels.get(axis), count)
+        else:
+            column = linearSamples(start, target, count)
+        columns[axis] = column + [ target ] * (numFrames - count) # Hold.
+    return [ dict((axis, columns[axis][index]) for axis in axes)
+             for index in xrange(numFrames) ]
+
+def easeSteps(position, speed, accel, low=None, high=None):
+    # Positions, one per tick, that slow speed (units per tick) to a stop at
+    # accel, within low..high. The last one is the hold position.
+    steps = []
+    while speed:
+        if (accel == None) or (abs(speed) <= accel): speed = 0
+        else: speed -= accel if (speed > 0) else -accel
+        position += speed
+        if (low != None): position = max(position, low)
+        if (high != None): position = min(position, high)
+        steps.append(position)
+    return steps
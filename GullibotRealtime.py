@@ -0,0 +1,302 @@
+"""
+Motion process for Gullibot.
+
+MotionProcess runs the servo/LED output loop (a MotionClock and the
+ServoblasterWriter) in its own process, so console I/O, printing and file
+loading in the session cannot hold it up; it also raises its scheduling
+priority when the OS allows (SCHED_FIFO, else nice, else normal).
+
+The session feeds it through two single-producer, single-consumer rings in
+shared memory: "immediate" for one-off writes (LED levels, resets), played
+on the next tick, and "trajectory" for whole gestures, each frame stamped
+with the tick it is due on. Only the session moves a ring's head and only
+the motion process moves its tail, each after touching the slots, so
+neither side takes a lock across processes. There is no memory barrier
+either: on the Pi's ARM, the motion process may see a new head before the
+slot it guards. So each slot also carries its sequence number and a
+checksum, and the consumer takes a slot only once both match; until then
+the record is treated as not yet pushed. Current positions, the tick
+counter and timing stats come back through shared arrays.
+
+A cancel drops the queued trajectory on the motion process's next tick,
+which then eases each channel from its current speed to a hold (at the
+rates set with setEasing), so stopping does not wait on the session.
+
+MotionProcess stands in for the ServoblasterWriter (write, tick, close,
+stats), plus schedule()/waitFor() for trajectories; see playFrames.
+"""
+
+import os
+import time
+import collections
+import ctypes
+import ctypes.util
+import threading
+import contextlib
+import multiprocessing
+
+from GullibotDevices import ServoblasterWriter
+from GullibotClock import MotionClock
+from GullibotMotion import easeSteps
+
+NUM_CHANNELS = 32
+(SET, FORCE, CANCEL, RESET, ACCEL, LOW, HIGH) = range(7) # Record kinds.
+PRIORITIES = [ "normal", "nice", "fifo" ]
+STATS = [ "ticks", "overruns", "missedDeadlines", "maxLateness", "jitterP50",
+          "jitterP99", "writesIssued", "writesSkipped", "updatesSent" ]
+
+def checksum(sequence, record):
+    # Both processes compute this the same way, so a slot read whole
+    # matches exactly; a slot read half-written almost surely does not.
+    (tick, kind, channel, value) = record
+    return (sequence * 3.0 + tick * 5.0 + kind * 7.0 + channel * 11.0 +
+            value * 13.0)
+
+class SharedRing(object):
+    # Fixed-size records of floats: (tick, kind, channel, value), stored
+    # as (sequence, tick, kind, channel, value, checksum) slots.
+    width = 6
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.slots = multiprocessing.RawArray(ctypes.c_double, capacity * self.width)
+        self.head = multiprocessing.RawValue(ctypes.c_ulong, 0) # Records pushed.
+        self.tail = multiprocessing.RawValue(ctypes.c_ulong, 0) # Records popped.
+
+    def __len__(self):
+        return self.head.value - self.tail.value
+
+    def push(self, record):
+        # Producer side. Returns False when full.
+        head = self.head.value
+        if (head - self.tail.value >= self.capacity): return False
+        base = (head % self.capacity) * self.width
+        record = tuple(record)
+        self.slots[base:base + self.width] = \
+            (head + 1,) + record + (checksum(head + 1, record),)
+        self.head.value = head + 1 # Publish after the slot is written.
+        return True
+
+    def peek(self):
+        # Consumer side: the oldest record, or None (also while its slot is
+        # not fully visible yet; the next peek tries again). The record is
+        # a copy, so the producer may reuse the slot once it is popped.
+        tail = self.tail.value
+        if (tail == self.head.value): return None
+        base = (tail % self.capacity) * self.width
+        slot = self.slots[base:base + self.width]
+        record = slot[1:5]
+        if (slot[0] != tail + 1) or (slot[5] != checksum(tail + 1, record)):
+            return None
+        return record
+
+    def pop(self):
+        self.tail.value += 1
+
+    def discardTo(self, count):
+        # Consumer side: drops records up to the count pushed (see head).
+        self.tail.value = max(self.tail.value, count)
+
+def raisePriority(fifoPriority=10, niceness=-10):
+    # Returns the index in PRIORITIES of what the OS allowed.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        param = ctypes.c_int(fifoPriority)
+        if (libc.sched_setscheduler(0, 1, ctypes.byref(param)) == 0): # SCHED_FIFO
+            return PRIORITIES.index("fifo")
+    except (OSError, AttributeError):
+        pass
+    try:
+        os.nice(niceness)
+        return PRIORITIES.index("nice")
+    except OSError:
+        return PRIORITIES.index("normal")
+
+def motionLoop(immediate, trajectory, shared, devicePath, period, realtime):
+    # Runs in the motion process until the stop flag (state[2]) is set.
+    (positions, stats, state, cancelTime) = shared
+    state[1] = raisePriority() if realtime else 0
+    writer = ServoblasterWriter(devicePath)
+    clock = MotionClock(period=period)
+    clock.start()
+    easing = collections.defaultdict(lambda: [ None, None, None ]) # accel, low, high
+    speeds = {}                 # channel -> units moved on the last tick
+    moved = set()               # channels written this tick
+    ease = collections.deque()  # easing frames still to play
+    cancels = [ 0 ]             # cancels not yet eased to a hold
+    def output(channel, value, force=False):
+        if (channel in speeds) or (channel in moved): # Written before.
+            speeds[channel] = value - positions[channel]
+        else:
+            speeds[channel] = 0
+        moved.add(channel)
+        writer.write(channel, value, force)
+        positions[channel] = value
+    def easeToHold():
+        columns = dict((channel, easeSteps(positions[channel], speeds[channel],
+                                           *easing[channel]))
+                       for channel in speeds if (channel in easing))
+        numFrames = max([ 0 ] + [ len(column) for column in columns.values() ])
+        ease.clear()
+        for index in xrange(numFrames):
+            ease.append(dict((channel, column[min(index, len(column) - 1)])
+                             for (channel, column) in columns.items() if column))
+    def apply(record):
+        (kind, channel, value) = (int(record[1]), int(record[2]), record[3])
+        if (kind == CANCEL): # value: trajectory records pushed before it.
+            trajectory.discardTo(int(value))
+            easeToHold()
+            cancelTime[0] = time.time()
+            cancels[0] += 1
+        elif (kind == RESET):
+            (writer.writesIssued, writer.writesSkipped, writer.updatesSent) = (0, 0, 0)
+            clock.resetStats()
+        elif (kind in [ ACCEL, LOW, HIGH ]):
+            easing[channel][kind - ACCEL] = value
+        else:
+            output(channel, value, force=(kind == FORCE))
+    while not state[2]:
+        clock.wait()
+        tick = clock.tickIndex
+        with writer.tick(): # One device write per tick.
+            record = immediate.peek()
+            while (record != None):
+                apply(record)
+                immediate.pop()
+                record = immediate.peek()
+            if ease:
+                frame = ease.popleft()
+                for channel in frame: output(channel, frame[channel])
+            record = trajectory.peek()
+            while (record != None) and (record[0] <= tick):
+                apply(record)
+                trajectory.pop()
+                record = trajectory.peek()
+        for channel in speeds:
+            if (channel not in moved): speeds[channel] = 0
+        moved.clear()
+        if cancels[0] and not ease: # Holding.
+            state[3] += cancels[0]
+            cancels[0] = 0
+        state[0] = tick
+        if (clock.ticks % 20 == 0): # Publish stats now and then.
+            values = clock.stats()
+            values.update(writer.stats())
+            stats[:] = [ float(values[name]) for name in STATS ]
+    writer.close()
+
+class MotionProcess(object):
+    def __init__(self, devicePath="/dev/servoblaster", period=0.01,
+                 capacity=4096, realtime=True, lead=2):
+        # lead: ticks between scheduling a trajectory and its first frame.
+        (self.period, self.lead) = (period, lead)
+        self.immediate = SharedRing(256)
+        self.trajectory = SharedRing(capacity)
+        self.positions = multiprocessing.RawArray(ctypes.c_double, NUM_CHANNELS)
+        self.shared = multiprocessing.RawArray(ctypes.c_double, len(STATS))
+        # tick, priority, stop flag, cancels eased to a hold
+        self.state = multiprocessing.RawArray(ctypes.c_long, 4)
+        self.cancelTime = multiprocessing.RawArray(ctypes.c_double, 1)
+        self.lock = threading.RLock() # Session threads share one producer side.
+        self.lastScheduled = -1
+        self.cancels = 0
+        self.listener = None # As ServoblasterWriter; called when queued.
+        self.process = multiprocessing.Process(target=motionLoop, name="motion",
+            args=(self.immediate, self.trajectory,
+                  (self.positions, self.shared, self.state, self.cancelTime),
+                  devicePath, period, realtime))
+        self.process.daemon = True
+        self.process.start()
+
+    def push(self, ring, record):
+        while not ring.push(record): # Full: the motion process is behind.
+            time.sleep(self.period)
+
+    def write(self, channel, position, force=False):
+        with self.lock:
+            self.push(self.immediate, (0, FORCE if force else SET, channel, position))
+        if (self.listener != None): self.listener(time.time())
+
+    @contextlib.contextmanager
+    def tick(self):
+        # Writes are grouped per tick by the motion process; this only
+        # serializes the session's threads.
+        with self.lock:
+            yield self
+
+    def currentTick(self):
+        return self.state[0]
+
+    def priority(self):
+        return PRIORITIES[self.state[1]]
+
+    def position(self, channel):
+        return self.positions[channel]
+
+    def schedule(self, frames):
+        # Queues frames (dicts of channel -> position), one per tick, right
+        # after anything still queued. Returns the tick of the last frame.
+        with self.lock:
+            tick = max(self.currentTick() + self.lead, self.lastScheduled + 1)
+            for frame in frames:
+                for channel in sorted(frame):
+                    self.push(self.trajectory, (tick, SET, channel, frame[channel]))
+                tick += 1
+            self.lastScheduled = tick - 1
+        if (self.listener != None): self.listener(time.time())
+        return self.lastScheduled
+
+    def setEasing(self, channel, accel, low=None, high=None):
+        # How a cancel slows this channel down: accel per tick per tick,
+        # staying within low..high.
+        with self.lock:
+            self.push(self.immediate, (0, ACCEL, channel, accel))
+            if (low != None): self.push(self.immediate, (0, LOW, channel, low))
+            if (high != None): self.push(self.immediate, (0, HIGH, channel, high))
+
+    def cancel(self):
+        # Drops every trajectory frame queued so far, and eases to a hold,
+        # from the next tick the motion process plays. Returns a count for
+        # waitCancelled.
+        with self.lock:
+            self.push(self.immediate, (0, CANCEL, 0, self.trajectory.head.value))
+            self.lastScheduled = -1
+            self.cancels += 1
+            return self.cancels
+
+    def waitCancelled(self, count, timeout=5.0):
+        # Blocks until cancel number count is holding. Returns the time its
+        # tick started easing.
+        deadline = time.time() + timeout
+        while (self.state[3] < count) and (time.time() < deadline):
+            if not self.process.is_alive(): raise IOError("Motion process died.")
+            time.sleep(self.period / 2)
+        return self.cancelTime[0]
+
+    def waitFor(self, tick, timeout=None):
+        # Blocks until the motion process has played tick. False on timeout.
+        deadline = None if (timeout == None) else time.time() + timeout
+        while (self.currentTick() < tick):
+            if not self.process.is_alive(): raise IOError("Motion process died.")
+            if (deadline != None) and (time.time() >= deadline): return False
+            time.sleep(self.period / 2)
+        return True
+
+    def stats(self):
+        values = dict(zip(STATS, self.shared[:]))
+        for name in [ "ticks", "overruns", "missedDeadlines", "writesIssued",
+                      "writesSkipped", "updatesSent" ]:
+            values[name] = int(values[name])
+        values["priority"] = self.priority()
+        return values
+
+    def resetCounters(self):
+        with self.lock:
+            self.push(self.immediate, (0, RESET, 0, 0))
+
+    def close(self):
+        if self.process.is_alive():
+            self.waitFor(self.lastScheduled, timeout=5.0)
+            self.state[2] = 1
+            self.process.join(2.0)
+        if self.process.is_alive(): self.process.terminate()
@@ -0,0 +1,215 @@
+"""
+Session recorder for Gullibot study data.
+
+SessionRecorder keeps an append-only binary log of what the robot did:
+commands, LCD frames, servo and LED setpoints, timeline stages, operator
+prompts and answers, audio clips and cancelled gestures. record() only
+appends a tuple to a bounded in-memory queue; a background thread packs
+the queue with struct and writes it in batches, so the motion loop never
+waits on the disk. If the queue is full, events are dropped and counted
+(a "dropped" event says how many). Files rotate at rotateBytes:
+session.rec, session.rec.1 (older), ... up to keep old files.
+
+Each event is 16 bytes plus its text:
+    time (double), kind (byte), channel (byte), value (float),
+    text length (ushort), text (UTF-8)
+
+Byte strings (console input, script text) are written as they are; unicode
+is encoded as UTF-8. Text that is not valid UTF-8 reads back with U+FFFD in
+place of the bad bytes.
+
+    python GullibotRecorder.py export session.rec -o session.csv
+    python GullibotRecorder.py summary session.rec
+"""
+
+import os
+import csv
+import sys
+import time
+import struct
+import argparse
+import threading
+import collections
+
+MAGIC = "GULLIBOT-REC 1\n"
+EVENT = struct.Struct("<dBBfH")
+KINDS = [ "none", "command", "lcd", "servo", "stage", "prompt", "answer",
+          "audio", "cancel", "dropped" ]
+(COMMAND, LCD, SERVO, STAGE, PROMPT, ANSWER, AUDIO, CANCEL, DROPPED) = range(1, 10)
+
+class NullRecorder(object):
+    enabled = False
+
+    def record(self, kind, channel=0, value=0.0, text=None): pass
+    def flush(self): pass
+    def close(self): pass
+
+class SessionRecorder(object):
+    enabled = True
+
+    def __init__(self, path, maxPending=50000, flushInterval=0.25,
+                 rotateBytes=16 << 20, keep=4, now=time.time):
+        (self.path, self.now) = (path, now)
+        (self.maxPending, self.flushInterval) = (maxPending, flushInterval)
+        (self.rotateBytes, self.keep) = (rotateBytes, keep)
+        self.pending = collections.deque() # Appended here, popped by the writer.
+        self.dropped = 0      # Not yet reported in the log.
+        self.droppedLock = threading.Lock() # Any thread may drop.
+        self.recorded = 0
+        self.bytesWritten = 0
+        self.writeErrors = 0  # Batches the writer thread failed to write.
+        self.output = None
+        self.open()
+        self.stopped = threading.Event()
+        self.flushed = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="recorder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, kind, channel=0, value=0.0, text=None):
+        # Hot path: no packing, no I/O.
+        if (len(self.pending) >= self.maxPending):
+            with self.droppedLock: self.dropped += 1
+            return
+        self.pending.append((self.now(), kind, channel, value, text))
+
+    def open(self):
+        self.output = open(self.path, "ab")
+        if (self.output.tell() == 0): self.output.write(MAGIC)
+
+    def rotate(self):
+        # session.rec -> session.rec.1 -> session.rec.2 ...; oldest deleted.
+        self.output.close()
+        for index in xrange(self.keep, 0, -1):
+            older = "%s.%d" % (self.path, index)
+            newer = "%s.%d" % (self.path, index - 1) if (index > 1) else self.path
+            if os.path.exists(newer):
+                if os.path.exists(older): os.remove(older)
+                os.rename(newer, older)
+        self.open()
+
+    def pack(self, event):
+        (when, kind, channel, value, text) = event
+        if (text == None): data = ""
+        elif isinstance(text, unicode): data = text.encode("utf-8")
+        else: data = str(text)
+        data = data[:0xffff] # The length is a ushort.
+        return EVENT.pack(when, kind, channel & 0xff, value, len(data)) + data
+
+    def writeBatch(self):
+        chunks = []
+        with self.droppedLock:
+            (count, self.dropped) = (self.dropped, 0)
+        if count:
+            chunks.append(self.pack((self.now(), DROPPED, 0, count, None)))
+        while self.pending:
+            event = self.pending.popleft()
+            try:
+                chunks.append(self.pack(event))
+            except (struct.error, UnicodeError, TypeError):
+                with self.droppedLock: self.dropped += 1
+        if not chunks: return
+        data = "".join(chunks)
+        if (self.output.tell() + len(data) > self.rotateBytes): self.rotate()
+        self.output.write(data)
+        self.output.flush()
+        self.recorded += len(chunks)
+        self.bytesWritten += len(data)
+
+    def work(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.flushInterval)
+            try:
+                self.writeBatch()
+            except Exception as error: # Keep recording after a bad batch.
+                self.writeErrors += 1
+                sys.stderr.write("Recorder: batch not written: %s\n" % error)
+            self.flushed.set()
+
+    def flush(self):
+        # Waits for the writer to catch up with everything recorded so far.
+        self.flushed.clear()
+        while self.pending and self.thread.is_alive():
+            self.flushed.wait(self.flushInterval)
+            self.flushed.clear()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.writeBatch()
+        self.output.close()
+
+def recorderFromEnvironment(now=time.time):
+    path = os.environ.get("GULLIBOT_RECORD", "")
+    if path: return SessionRecorder(path, now=now)
+    return NullRecorder()
+
+def sessionFiles(path):
+    # The rotated files, oldest first, then the current one.
+    files = []
+    index = 1
+    while os.path.exists("%s.%d" % (path, index)):
+        files.insert(0, "%s.%d" % (path, index))
+        index += 1
+    if os.path.exists(path): files.append(path)
+    return files
+
+def readEvents(path):
+    # Yields (time, kind name, channel, value, text) from one file.
+    with open(path, "rb") as data:
+        if (data.read(len(MAGIC)) != MAGIC):
+            raise ValueError("%s is not a Gullibot recording." % path)
+        while True:
+            header = data.read(EVENT.size)
+            if (len(header) < EVENT.size): break # End (or a cut-off write).
+            (when, kind, channel, value, length) = EVENT.unpack(header)
+            text = data.read(length).decode("utf-8", "replace") if length else None
+            yield (when, KINDS[kind] if (kind < len(KINDS)) else str(kind),
+                   channel, value, text)
+
+def readSession(path):
+    for name in sessionFiles(path):
+        for event in readEvents(name):
+            yield event
+
+def exportCsv(path, output):
+    writer = csv.writer(output)
+    writer.writerow([ "time", "kind", "channel", "value", "text" ])
+    count = 0
+    for (when, kind, channel, value, text) in readSession(path):
+        writer.writerow([ "%.6f" % when, kind, channel, "%g" % value,
+                          (text or "").encode("utf-8") ])
+        count += 1
+    return count
+
+def summary(path):
+    counts = collections.Counter()
+    (first, last) = (None, None)
+    for event in readSession(path):
+        counts[event[1]] += 1
+        if (first == None): first = event[0]
+        last = event[0]
+    return (counts, first, last)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gullibot session recordings.")
+    parser.add_argument("action", choices=["export", "summary"])
+    parser.add_argument("path", help="recording (its rotated files are included)")
+    parser.add_argument("-o", "--output", help="CSV file (default stdout)")
+    args = parser.parse_args(argv)
+    if (args.action == "export"):
+        output = open(args.output, "wb") if args.output else sys.stdout
+        try:
+            count = exportCsv(args.path, output)
+        finally:
+            if args.output: output.close()
+        sys.stderr.write("Exported %d events.\n" % count)
+    else:
+        (counts, first, last) = summary(args.path)
+        for kind in sorted(counts):
+            print "%-8s %8d" % (kind, counts[kind])
+        if (first != None):
+            print "%.1f s from %s" % (last - first, time.ctime(first))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Concurrent control runtime for Gullibot.
+
+The console is read on its own thread, so commands can be typed while a
+gesture is still moving. Each command is routed to a lane: servo and LED
+commands go to the motion lane, text goes to the display lane. Every lane
+runs its queue in order on a worker thread over the session's existing
+setServo and lcd output paths, so a "say" does not wait for a scan to end.
+
+A new pan, tilt or servo command preempts the gesture that is moving (it
+eases to a hold on the next tick, see GullibotJobs), and "stop" also drops
+motion commands still queued. Batch runs queue without preempting: there
+"stop" waits its turn on the motion lane like any other command, so the
+file runs in order.
+
+(Python 2 has no asyncio; threads and Queue give the same structure.)
+"""
+
+import sys
+import time
+import threading
+import collections
+import Queue
+
+from GullibotCommands import splitCommands, CommandError
+
+class CommandLane(object):
+    # One worker thread draining one FIFO of (stamp, parsed, validated)
+    # commands; validated is the registry's (spec, values).
+    def __init__(self, name, runtime):
+        self.name = name
+        self.runtime = runtime
+        self.queue = Queue.Queue()
+        self.busy = False
+        self.thread = threading.Thread(target=self.work, name=name)
+        self.thread.daemon = True
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if (item == None): break
+            (stamp, parsed, validated) = item
+            self.busy = True
+            try:
+                self.runtime.execute(stamp, parsed, validated)
+            finally:
+                self.busy = False
+                self.queue.task_done()
+
+class SessionRuntime(object):
+    lanes = { "pan":"motion", "tilt":"motion", "servo":"motion",
+              "light":"motion", "stop":"motion", "say":"display" }
+    preempting = [ "pan", "tilt", "servo" ]
+
+    def __init__(self, session, stream=None, historySize=500, preempt=True):
+        self.session = session
+        self.preempt = preempt
+        self.stream = stream if (stream != None) else sys.stdin
+        self.printLock = threading.Lock()
+        self.latencies = collections.deque(maxlen=historySize) # seconds
+        self.stopped = threading.Event()
+        self.workers = {}
+        for name in set(SessionRuntime.lanes.values()):
+            self.workers[name] = CommandLane(name, self)
+
+    def say(self, *words):
+        with self.printLock:
+            print " ".join(str(word) for word in words)
+
+    def readLine(self, prompt=""):
+        # raw_input over self.stream (no prompt is printed).
+        line = self.stream.readline()
+        if (line == ""): raise EOFError()
+        return line.rstrip("\n")
+
+    def readConsole(self):
+        # Blocking reads stay on this thread; everything else keeps running.
+        # Lines go through session.readInput, so the recorder sees them.
+        while not self.stopped.is_set():
+            try:
+                line = self.session.readInput(">", self.readLine)
+            except EOFError:
+                break
+            self.submit(line, time.time())
+        self.stop()
+
+    def submit(self, line, stamp=None):
+        # Queues each command on the line ("pan 175; say 3") on its lane.
+        if (stamp == None): stamp = time.time()
+        for parsed in splitCommands(line):
+            self.submitParsed(parsed, stamp)
+
+    def submitParsed(self, parsed, stamp=None, echo=True):
+        # Checks one parsed command and queues it. Returns True if queued.
+        if (stamp == None): stamp = time.time()
+        if (parsed[0] in ["quit", "exit"]):
+            self.stop()
+            return False
+        elif (parsed[0] == "status"):
+            with self.printLock: self.session.displayStatus()
+            return False
+        if (parsed[0] not in self.session.validCmds):
+            self.say("Invalid command.")
+            return False
+        try: # Once; the lane runs the checked command as is.
+            validated = self.session.commands.validate(self.session, parsed)
+        except CommandError as error:
+            self.say("Invalid command.", error)
+            return False
+        if self.preempt and (parsed[0] == "stop"):
+            self.stopMotion(stamp)
+            return True
+        worker = self.workers[SessionRuntime.lanes[parsed[0]]]
+        if self.preempt and (parsed[0] in SessionRuntime.preempting):
+            self.session.motionJobs.cancel(stamp) # Running gesture, if any.
+        if echo and (worker.busy or not worker.queue.empty()):
+            self.say("Queued:", " ".join(parsed))
+        worker.queue.put((stamp, parsed, validated))
+        return True
+
+    def stopMotion(self, stamp):
+        # Drops queued motion commands and cancels the running one.
+        queue = self.workers["motion"].queue
+        dropped = 0
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                break
+            if (item == None):
+                queue.put(None) # Shutting down; leave that in place.
+                queue.task_done()
+                break
+            dropped += 1
+            queue.task_done()
+        if (self.session.motionJobs.cancel(stamp) != None) or dropped:
+            self.say("Stopping." if not dropped else
+                     "Stopping. (%d queued commands dropped)" % dropped)
+        else:
+            self.say("Nothing is moving.")
+
+    def execute(self, stamp, parsed, validated=None):
+        # Latency is measured on the motion lane only: it alone sets the
+        # writer's listener, which ignores writes from other threads (the
+        # LED thread, a "say" on the display lane).
+        lane = threading.current_thread()
+        measured = (lane is self.workers["motion"].thread)
+        writer = self.session.servoWriter
+        firstWrite = []
+        def listener(when):
+            if (threading.current_thread() is lane) and not firstWrite:
+                firstWrite.append(when)
+        if measured: writer.listener = listener
+        try:
+            self.session.executeCmd(parsed, validated)
+        except Exception as error:
+            self.say("Command failed:", error)
+        finally:
+            if measured: writer.listener = None
+        if firstWrite:
+            latency = firstWrite[0] - stamp
+            self.latencies.append(latency)
+            self.say("Done. (%.1f ms to first servo write)" % (latency * 1000))
+        else:
+            self.say("Done.")
+
+    def start(self):
+        for name in self.workers:
+            self.workers[name].thread.start()
+        reader = threading.Thread(target=self.readConsole, name="console")
+        reader.daemon = True
+        reader.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def wait(self):
+        # Blocks until "quit" or EOF, then lets queued commands finish.
+        while not self.stopped.is_set():
+            self.stopped.wait(0.1)
+        for name in self.workers:
+            self.workers[name].queue.put(None)
+            self.workers[name].thread.join()
+
+    def run(self):
+        self.start()
+        self.wait()
+        self.report()
+
+    def stats(self):
+        samples = sorted(self.latencies)
+        if not samples: return { "commands": 0 }
+        return { "commands": len(samples),
+                 "latencyP50": samples[len(samples) // 2],
+                 "latencyMax": samples[-1] }
+
+    def report(self):
+        stats = self.stats()
+        if stats["commands"]:
+            self.say("Command latency: p50 %.1f ms, max %.1f ms over %d commands."
+                     % (stats["latencyP50"] * 1000, stats["latencyMax"] * 1000,
+                        stats["commands"]))
@@ -0,0 +1,346 @@
+"""
+Command server for Gullibot.
+
+Serves one GullibotSession over localhost TCP or a Unix domain socket
+(--socket PATH), in place of typing at mainLoop's prompt over SSH. The
+protocol is one JSON object per line in each direction:
+
+    request:  {"id": 7, "cmd": "pan 175"}
+    reply:    {"id": 7, "ok": true, "elapsed": 0.12,
+               "servoPositions": {...}, "ledLevels": {...}, "moving": false}
+
+A request with "ack": true is acknowledged with {"id": 7, "ack": true} as
+soon as it is read, before it waits its turn. "watch" subscribes the
+connection to status events, sent every statusInterval seconds while
+anything changed, with only the fields that did:
+
+    {"event": "status", "servoPositions": {"pan": 176.4}, "moving": true}
+
+Commands are the operator commands (pan, tilt, say, light, servo scan)
+plus "status". They run one at a time through executeCmd, whichever
+connection they arrive on, except "stop", which cancels the running
+gesture right away. Connections are persistent; a client can keep
+sending requests on the same socket.
+
+    python GullibotServer.py --standin --port 0
+starts a robot on stand-in devices (for fleet testing) and prints the port.
+
+    python GullibotServer.py --load --socket /tmp/gullibot.sock --clients 4
+is the load generator: CommandClients send commands back to back for a
+while, then it reports round-trip latency percentiles and commands/s.
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import argparse
+import threading
+import SocketServer
+
+from GullibotCmd import GullibotSession
+from GullibotDevices import EventLog, RecordingPWM, RecordingDisplay, RecordingAudio
+
+def standInSession(maxEvents=10000):
+    # A session on recording stand-in devices, with no hardware needed.
+    log = EventLog(maxEvents=maxEvents)
+    return GullibotSession(pwm=RecordingPWM(log), display=RecordingDisplay(log),
+                           audio=RecordingAudio(log),
+                           inputFunc=lambda prompt="": "n")
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        # Replies are small and go out at once; Nagle would hold them back.
+        self.disable_nagle_algorithm = (self.server.address_family != socket.AF_UNIX)
+        SocketServer.StreamRequestHandler.setup(self)
+        self.writeLock = threading.Lock() # Replies and status events share wfile.
+
+    def send(self, message):
+        with self.writeLock:
+            self.wfile.write(json.dumps(message, separators=(",", ":")) + "\n")
+            self.wfile.flush()
+
+    def handle(self):
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line: break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict) or \
+                   not isinstance(request.get("cmd", ""), basestring):
+                    request = { "id": request.get("id", None)
+                                      if isinstance(request, dict) else None }
+                    reply = { "ok": False, "error": "Bad request." }
+                else:
+                    if request.get("ack", False):
+                        self.send({ "id": request.get("id", None), "ack": True })
+                    if (request.get("cmd", "").strip() == "watch"):
+                        reply = self.server.watch(self)
+                    else:
+                        reply = self.server.runCommand(request.get("cmd", ""))
+                reply["id"] = request.get("id", None)
+                self.send(reply)
+        finally:
+            self.server.unwatch(self)
+
+class CommandService(object):
+    # What the TCP and Unix socket servers share: one session, run one
+    # command at a time, and the connections watching its status.
+    statusInterval = 0.05 # seconds between status events, while changing
+
+    def initService(self, session):
+        self.session = session
+        self.lock = threading.Lock() # One command at a time on the robot.
+        self.session.initControls()
+        self.watchers = set()
+        self.watchLock = threading.Lock()
+        self.publisher = None
+
+    def status(self):
+        session = self.session
+        return { "servoPositions": dict(session.servoPositions),
+                 "ledLevels": dict(session.ledLevels),
+                 "moving": session.motionJobs.current != None }
+
+    def watch(self, handler):
+        with self.watchLock:
+            self.watchers.add(handler)
+            if (self.publisher == None):
+                self.publisher = threading.Thread(target=self.publish, name="status")
+                self.publisher.daemon = True
+                self.publisher.start()
+        reply = { "ok": True }
+        reply.update(self.status())
+        return reply
+
+    def unwatch(self, handler):
+        with self.watchLock:
+            self.watchers.discard(handler)
+
+    def publish(self):
+        # Sends each watcher what changed since the last event.
+        last = self.status()
+        while True:
+            time.sleep(self.statusInterval)
+            current = self.status()
+            event = {}
+            for (key, value) in current.items():
+                if isinstance(value, dict):
+                    changed = dict(item for item in value.items()
+                                   if (last[key].get(item[0], None) != item[1]))
+                    if changed: event[key] = changed
+                elif (value != last[key]):
+                    event[key] = value
+            last = current
+            if not event: continue
+            event["event"] = "status"
+            with self.watchLock:
+                watchers = list(self.watchers)
+            for handler in watchers:
+                try:
+                    handler.send(event)
+                except (IOError, socket.error):
+                    self.unwatch(handler)
+
+    def runCommand(self, cmd):
+        parsed = GullibotSession.parseCmd(cmd)
+        start = time.time()
+        if (parsed == ["stop"]): # Must not wait for the gesture it stops.
+            self.session.motionJobs.cancel(start)
+            reply = { "ok": True }
+            reply.update(self.status())
+            reply["elapsed"] = time.time() - start
+            return reply
+        with self.lock:
+            if (parsed == ["status"]):
+                reply = { "ok": True }
+            elif (parsed != []) and (parsed[0] in self.session.validCmds):
+                try:
+                    # Validated here: executeCmd only prints a rejection.
+                    validated = self.session.commands.validate(self.session, parsed)
+                    self.session.executeCmd(parsed, validated)
+                    reply = { "ok": True }
+                except Exception as error:
+                    reply = { "ok": False, "error": str(error) }
+            else:
+                reply = { "ok": False, "error": "Invalid command." }
+            reply.update(self.status())
+        reply["elapsed"] = time.time() - start
+        return reply
+
+class CommandServer(CommandService, SocketServer.ThreadingMixIn,
+                    SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, session, address=("127.0.0.1", 0)):
+        SocketServer.TCPServer.__init__(self, address, CommandHandler)
+        self.initService(session)
+
+class UnixCommandServer(CommandService, SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    # Local clients only; no TCP stack between them and the robot.
+    daemon_threads = True
+
+    def __init__(self, session, path="/tmp/gullibot.sock"):
+        if os.path.exists(path): # Left over from a server that died.
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise IOError("%s exists and is not a socket." % path)
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+        self.initService(session)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address): os.remove(self.server_address)
+
+class CommandClient(object):
+    # A thin client: address is a Unix socket path or (host, port).
+    def __init__(self, address, timeout=30.0):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(address, timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+        self.nextId = 0
+        self.status = {} # Kept up to date from status events (see watch).
+
+    def read(self):
+        line = self.rfile.readline()
+        if not line: raise IOError("Server closed the connection.")
+        return json.loads(line)
+
+    def apply(self, event):
+        for (key, value) in event.items():
+            if isinstance(value, dict): self.status.setdefault(key, {}).update(value)
+            elif (key != "event"): self.status[key] = value
+
+    def request(self, cmd, ack=False):
+        # Returns the reply; status events read on the way are applied.
+        self.nextId += 1
+        message = { "id": self.nextId, "cmd": cmd }
+        if ack: message["ack"] = True
+        self.sock.sendall(json.dumps(message, separators=(",", ":")) + "\n")
+        while True:
+            reply = self.read()
+            if ("event" in reply): self.apply(reply)
+            elif (reply.get("id", None) == self.nextId) and ("ack" not in reply):
+                return reply
+
+    def watch(self):
+        reply = self.request("watch")
+        self.apply(dict((key, reply[key]) for key in
+                        [ "servoPositions", "ledLevels", "moving" ] if (key in reply)))
+        return reply
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+LOAD_COMMANDS = [ "light on", "light off", "status" ]
+
+def loadTest(address, clients=4, seconds=5.0, commands=LOAD_COMMANDS):
+    # Each client sends commands back to back (one outstanding at a time)
+    # until the time is up.
+    latencies = []
+    failures = [ 0 ]
+    lock = threading.Lock()
+    connections = [ CommandClient(address) for index in xrange(clients) ]
+    for connection in connections: connection.request("status") # Warm up.
+    start = time.time()
+    deadline = start + seconds
+    def work(connection, offset):
+        samples = []
+        failed = 0
+        index = offset
+        while (time.time() < deadline):
+            sent = time.time()
+            reply = connection.request(commands[index % len(commands)])
+            samples.append(time.time() - sent)
+            if not reply.get("ok", False): failed += 1
+            index += 1
+        with lock:
+            latencies.extend(samples)
+            failures[0] += failed
+    threads = [ threading.Thread(target=work, args=(connections[index], index))
+                for index in xrange(clients) ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
+    for connection in connections: connection.close()
+    samples = sorted(latencies)
+    def percentile(p):
+        if not samples: return 0.0
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+    return { "clients": clients, "commands": len(samples),
+             "failures": failures[0], "seconds": elapsed,
+             "commandsPerSecond": len(samples) / elapsed,
+             "latencyP50Ms": percentile(0.50), "latencyP90Ms": percentile(0.90),
+             "latencyP99Ms": percentile(0.99),
+             "latencyMaxMs": samples[-1] * 1000 if samples else 0.0 }
+
+def printLoad(results):
+    print "%7s %9s %10s %8s %8s %8s %8s %6s" % (
+        "clients", "commands", "cmds/s", "p50 ms", "p90 ms", "p99 ms",
+        "max ms", "fails")
+    for row in results:
+        print "%7d %9d %10.1f %8.3f %8.3f %8.3f %8.3f %6d" % (
+            row["clients"], row["commands"], row["commandsPerSecond"],
+            row["latencyP50Ms"], row["latencyP90Ms"], row["latencyP99Ms"],
+            row["latencyMaxMs"], row["failures"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gullibot command server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8014,
+                        help="0 picks a free port")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="serve on (or, with --load, connect to) a Unix socket")
+    parser.add_argument("--standin", action="store_true",
+                        help="use recording stand-in devices, not the robot")
+    parser.add_argument("--quiet", action="store_true",
+                        help="discard the session's console output")
+    parser.add_argument("--load", action="store_true",
+                        help="run the load generator against a running server")
+    parser.add_argument("--clients", default="1,4",
+                        help="with --load: concurrent clients, e.g. 1,4,16")
+    parser.add_argument("--seconds", type=float, default=5.0,
+                        help="with --load: time per client count")
+    parser.add_argument("--cmd", action="append",
+                        help="with --load: command to send (repeatable)")
+    args = parser.parse_args(argv)
+    address = args.socket or (args.host, args.port)
+    if args.load:
+        printLoad([ loadTest(address, int(clients), args.seconds,
+                             args.cmd or LOAD_COMMANDS)
+                    for clients in args.clients.split(",") ])
+        return
+    console = sys.stdout
+    if args.quiet: sys.stdout = open(os.devnull, "w")
+    if args.standin:
+        session = standInSession()
+    else:
+        session = GullibotSession()
+    if args.socket:
+        server = UnixCommandServer(session, args.socket)
+        console.write("Listening on %s\n" % server.server_address)
+    else:
+        server = CommandServer(session, (args.host, args.port))
+        console.write("Listening on %s:%d\n" % server.server_address)
+    console.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        session.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Word wrapping and pagination for the Gullibot character display.
+
+wrapLines walks the words of a text once and yields padded display lines.
+Words longer than a line are hyphenated across lines. paginate groups those
+lines into pages for the LCD, which showPages flips through on a timer.
+For text that fits on one screen, the first page is exactly what lcdParser
+has always produced.
+"""
+
+def wrapLines(text, lineLength=20):
+    # Yields lines padded to lineLength. Splitting on single spaces (not
+    # runs of whitespace) matters: scripts use runs of spaces to push text
+    # onto the next line.
+    words = iter(text.replace("\n", " ").split(" "))
+    word = next(words, None)
+    while (word != None):
+        thisLine = []
+        used = 0 # ... accounting for final space.
+        while (word != None):
+            if (used + len(word)) <= lineLength:
+                thisLine.append(word)
+                used += (len(word) + 1)
+                word = next(words, None)
+            elif (used == 0):
+                # Too long for any line: hyphenate, carry the rest over.
+                thisLine.append(word[:lineLength - 1] + "-")
+                word = word[lineLength - 1:]
+                break
+            else: break
+        yield " ".join(thisLine).strip().ljust(lineLength)
+
+def paginate(text, lineLength=20, numLines=4):
+    # Yields pages, each a list of numLines padded lines. Always at least one.
+    blank = " " * lineLength
+    page = []
+    pages = 0
+    for line in wrapLines(text, lineLength):
+        page.append(line)
+        if (len(page) == numLines):
+            yield page
+            pages += 1
+            page = []
+    if ((pages == 0) or (page and (page.count(blank) < len(page)))):
+        yield page + [ blank ] * (numLines - len(page))
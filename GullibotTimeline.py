@@ -0,0 +1,202 @@
+"""
+Interaction timelines for Gullibot.
+
+A timeline file lists the steps of a study protocol, one per line:
+
+    stage NAME          marks a stage (for tracing)
+    print TEXT...       message for the operator's console
+    display MESSAGE     shows a script message (greeting, prescan, ...),
+                        page by page like say
+    say N               shows advice N (as the 'say' command)
+    gesture NAME [blink] runs a gesture (nod, scan)
+    led NAME PATTERN    starts an LED pattern (blink, fade, pulse, on, off)
+    wait SECONDS        pause
+    gate                wait for the operator to press ENTER
+    operator pan        operator aims the robot ('pan XXX', then 'next')
+
+'#' starts a comment. Timeline.compile checks every step and resolves its
+LCD pages once, when the file is loaded. While a step runs, the executor
+plans the next gesture's trajectory on a background thread from the
+robot's current position, so after a gate the servo writes start at once.
+"""
+
+import threading
+
+import GullibotLEDs
+import GullibotRecorder
+
+class TimelineError(ValueError):
+    pass
+
+class Step(object):
+    def __init__(self, lineNumber, verb, args):
+        (self.lineNumber, self.verb, self.args) = (lineNumber, verb, args)
+        self.pages = None  # display / say: precompiled LCD pages
+        self.planned = None # gesture: prefetched plan
+
+    def __repr__(self):
+        return "Step(%d, %s %s)" % (self.lineNumber, self.verb, " ".join(self.args))
+
+def parseTimeline(text):
+    # Yields Steps for the non-blank, non-comment lines of a timeline.
+    lines = text.splitlines()
+    for index in xrange(len(lines)):
+        line = lines[index].split("#", 1)[0].strip()
+        if not line: continue
+        words = line.split()
+        yield Step(index + 1, words[0].lower(), words[1:])
+
+class Timeline(object):
+    gestures = [ "nod", "scan" ]
+    patterns = [ "blink", "fade", "pulse", "on", "off" ]
+
+    def __init__(self, session, steps, name="timeline"):
+        self.session = session
+        self.steps = steps
+        self.name = name
+        self.prefetchHits = 0
+        self.prefetchMisses = 0
+        self.prefetcher = None
+
+    @staticmethod
+    def load(session, path):
+        with open(path, 'r') as data:
+            text = data.read()
+        return Timeline.compile(session, text, path)
+
+    @staticmethod
+    def compile(session, text, name="timeline"):
+        # Checks every step and resolves display pages; raises TimelineError.
+        steps = list(parseTimeline(text))
+        for step in steps:
+            check = getattr(Timeline, "check_" + step.verb, None)
+            if (check == None):
+                raise TimelineError("%s:%d: unknown step '%s'."
+                                    % (name, step.lineNumber, step.verb))
+            problem = check(session, step)
+            if (problem != None):
+                raise TimelineError("%s:%d: %s" % (name, step.lineNumber, problem))
+        return Timeline(session, steps, name)
+
+    ### Compile-time checks (return a problem string, or None) ###
+    @staticmethod
+    def check_stage(session, step):
+        if (len(step.args) != 1): return "stage takes one name."
+
+    @staticmethod
+    def check_print(session, step):
+        return None
+
+    @staticmethod
+    def check_display(session, step):
+        if (len(step.args) != 1) or (step.args[0] not in session.messages):
+            return "display takes one of: %s." % ", ".join(sorted(session.messages))
+        step.pages = session.messages[step.args[0]]
+
+    @staticmethod
+    def check_say(session, step):
+        try:
+            index = int(step.args[0])
+        except (IndexError, ValueError):
+            return "say takes an advice number."
+        if (index not in session.advicePages):
+            return "no advice number %d." % index
+        step.pages = session.advicePages[index]
+
+    @staticmethod
+    def check_gesture(session, step):
+        if (len(step.args) not in [1, 2]) or (step.args[0] not in Timeline.gestures):
+            return "gesture takes one of: %s [blink]." % ", ".join(Timeline.gestures)
+        if (len(step.args) == 2) and (step.args[1] != "blink"):
+            return "gesture option must be 'blink'."
+
+    @staticmethod
+    def check_led(session, step):
+        if (len(step.args) != 2) or (step.args[1] not in Timeline.patterns):
+            return "led takes an LED name and one of: %s." % ", ".join(Timeline.patterns)
+        # Names, not channels: ledChannels is empty when no LEDs are connected.
+        if (step.args[0] not in session.ledLevels):
+            return "no LED '%s' (LEDs: %s)." % (step.args[0],
+                                               ", ".join(sorted(session.ledLevels)))
+
+    @staticmethod
+    def check_wait(session, step):
+        try:
+            if (float(step.args[0]) < 0): return "wait must not be negative."
+        except (IndexError, ValueError):
+            return "wait takes a number of seconds."
+
+    @staticmethod
+    def check_gate(session, step):
+        if step.args: return "gate takes no arguments."
+
+    @staticmethod
+    def check_operator(session, step):
+        if (step.args != ["pan"]): return "only 'operator pan' is supported."
+
+    ### Execution ###
+    def prefetch(self, index):
+        # Plans the next gesture after index, in the background.
+        for step in self.steps[index + 1:]:
+            if (step.verb == "gesture"):
+                positions = dict(self.session.servoPositions)
+                def plan(step=step, positions=positions):
+                    step.planned = self.session.planGesture(step.args[0], positions)
+                self.prefetcher = threading.Thread(target=plan, name="prefetch")
+                self.prefetcher.daemon = True
+                self.prefetcher.start()
+                return
+
+    def run(self):
+        for index in xrange(len(self.steps)):
+            step = self.steps[index]
+            if (self.prefetcher != None):
+                self.prefetcher.join()
+                self.prefetcher = None
+            if (step.verb == "gesture"):
+                self.run_gesture(step)
+                self.prefetch(index) # Positions are known again.
+            else:
+                self.prefetch(index)
+                getattr(self, "run_" + step.verb)(step)
+        if (self.prefetcher != None): self.prefetcher.join()
+
+    def run_stage(self, step):
+        self.session.tracer.stage(step.args[0])
+        self.session.recorder.record(GullibotRecorder.STAGE, text=step.args[0])
+
+    def run_print(self, step):
+        print " ".join(step.args)
+
+    def run_display(self, step):
+        self.session.showPages(step.pages)
+
+    def run_say(self, step):
+        self.session.say(["say", step.args[0]])
+
+    def run_gesture(self, step):
+        planned = step.planned
+        if (planned != None) and (planned[0] == self.session.servoPositions):
+            self.prefetchHits += 1
+        else:
+            self.prefetchMisses += 1
+            planned = None
+        step.planned = None
+        self.session.playGesture(step.args[0], blink=("blink" in step.args),
+                                 planned=planned)
+
+    def run_led(self, step):
+        (name, pattern) = step.args
+        leds = self.session.leds
+        if (pattern == "on"): leds.stop(name, 220)
+        elif (pattern == "off"): leds.stop(name, 0)
+        else: leds.start(name, getattr(GullibotLEDs, pattern)())
+
+    def run_wait(self, step):
+        self.session.clock.sleep(float(step.args[0]))
+
+    def run_gate(self, step):
+        self.session.waitForOperator()
+
+    def run_operator(self, step):
+        self.session.panControl()
@@ -0,0 +1,119 @@
+"""
+Opt-in tracing for Gullibot hot paths.
+
+A Tracer wraps chosen session methods so each call is recorded as a span
+(name, start, end, thread) in preallocated ring-buffer lists; recording a
+span is a few list stores, with no allocation in the 10 ms motion loop.
+dump() writes the spans as Chrome / Perfetto trace JSON (chrome://tracing,
+ui.perfetto.dev).
+
+Tracing is off unless a Tracer is passed to GullibotSession or the
+GULLIBOT_TRACE environment variable names an output file. When it is off
+no method is wrapped at all; the only remaining cost is NullTracer.stage()
+at each runFullScript stage.
+"""
+
+import os
+import json
+import time
+import thread
+import itertools
+
+# Session methods wrapped when tracing is on.
+TRACED_METHODS = [ "setServo", "smoothServo", "moveAxes", "writeToCharDisplay",
+                   "lcdParser", "executeCmd", "say", "runScan", "nod" ]
+
+class NullTracer(object):
+    enabled = False
+
+    def instrument(self, target, names): pass
+    def stage(self, name): pass
+    def finish(self): pass
+
+class Tracer(object):
+    enabled = True
+
+    def __init__(self, capacity=65536, path=None, now=time.time):
+        self.capacity = capacity
+        self.path = path # Written by finish(), if given.
+        self.now = now
+        self.names = [ None ] * capacity
+        self.starts = [ 0.0 ] * capacity
+        self.ends = [ 0.0 ] * capacity
+        self.threads = [ 0 ] * capacity
+        self.counter = itertools.count() # next() is atomic under the GIL.
+        self.recorded = 0
+        self.origin = now()
+        self.stageName = None
+        self.stageStart = None
+
+    def record(self, name, start, end):
+        index = next(self.counter)
+        slot = index % self.capacity
+        self.names[slot] = name
+        self.starts[slot] = start
+        self.ends[slot] = end
+        self.threads[slot] = thread.get_ident()
+        self.recorded = index + 1
+
+    def wrap(self, name, function):
+        (record, now) = (self.record, self.now)
+        def traced(*args, **kwargs):
+            start = now()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, start, now())
+        traced.__name__ = function.__name__
+        return traced
+
+    def instrument(self, target, names):
+        # Replaces target's bound methods with traced versions.
+        for name in names:
+            method = getattr(target, name, None)
+            if (method != None):
+                setattr(target, name, self.wrap(name, method))
+
+    def stage(self, name):
+        # Ends the current script stage (as a span) and starts the next.
+        now = self.now()
+        if (self.stageName != None):
+            self.record("stage:" + self.stageName, self.stageStart, now)
+        (self.stageName, self.stageStart) = (name, now)
+
+    def spans(self):
+        # Recorded spans, oldest first (only the newest `capacity` survive).
+        first = max(0, self.recorded - self.capacity)
+        for index in xrange(first, self.recorded):
+            slot = index % self.capacity
+            if (self.names[slot] != None):
+                yield (self.names[slot], self.starts[slot], self.ends[slot],
+                       self.threads[slot])
+
+    def chromeTrace(self):
+        pid = os.getpid()
+        threadIds = {}
+        events = []
+        for (name, start, end, ident) in self.spans():
+            tid = threadIds.setdefault(ident, len(threadIds) + 1)
+            events.append({ "name": name, "ph": "X", "pid": pid, "tid": tid,
+                            "ts": (start - self.origin) * 1e6,
+                            "dur": (end - start) * 1e6 })
+        return { "traceEvents": events, "displayTimeUnit": "ms",
+                 "otherData": { "recorded": self.recorded,
+                                "dropped": max(0, self.recorded - self.capacity) } }
+
+    def dump(self, path):
+        with open(path, "w") as data:
+            json.dump(self.chromeTrace(), data)
+
+    def finish(self):
+        self.stage(None)
+        if (self.path != None):
+            self.dump(self.path)
+            print "Trace written to %s." % self.path
+
+def tracerFromEnvironment():
+    path = os.environ.get("GULLIBOT_TRACE", "")
+    if path: return Tracer(path=path)
+    return NullTracer()